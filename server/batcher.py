@@ -0,0 +1,75 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class MicroBatcher(object):
+    """
+    把并发到达的请求合并成 batch，由一个后台线程统一处理:
+    第一个请求到达后最多再等待 max_wait_ms，或凑满 max_batch_size 个请求，
+    然后调用一次 process_fn，并把结果按顺序分发给各个请求。
+    排队的请求超过 max_queue_size 时直接拒绝 (backpressure)
+    """
+
+    def __init__(self, process_fn, max_batch_size=8, max_wait_ms=20, max_queue_size=64):
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.requests = queue.Queue(maxsize=max_queue_size)
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, inst):
+        """
+        :return: Future，result() 为 process_fn 对该请求的输出
+        """
+        future = Future()
+        try:
+            self.requests.put_nowait((inst, future))
+        except queue.Full:
+            raise QueueFullError('Too many pending requests: %d' % self.requests.maxsize)
+        return future
+
+    def _next_batch(self):
+        items = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        # 跳过已经被取消的请求
+        return [(inst, future) for inst, future in items if future.set_running_or_notify_cancel()]
+
+    def _loop(self):
+        while True:
+            items = self._next_batch()
+            if not items:
+                continue
+
+            try:
+                results = self.process_fn([inst for inst, _ in items])
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            # 结果数与请求数不一致时无法确定对应关系，所有请求都返回错误，避免有请求一直等待
+            if len(results) != len(items):
+                e = RuntimeError('process_fn returned %d results for %d requests' % (len(results), len(items)))
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(items, results):
+                future.set_result(result)
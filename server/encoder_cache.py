@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+
+def _flatten(memory, prefix=()):
+    for key, value in memory.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix + (key,))
+        else:
+            yield prefix + (key,), value
+
+
+def _unflatten(items):
+    memory = {}
+    for path, value in items:
+        struct = memory
+        for key in path[:-1]:
+            struct = struct.setdefault(key, {})
+        struct[path[-1]] = value
+    return memory
+
+
+def memory_nbytes(memory):
+    return sum(value.numel() * value.element_size() for _, value in _flatten(memory))
+
+
+def _pad_to(tensor, shape):
+    # F.pad 的参数从最后一维开始
+    pad = []
+    for size, target in zip(reversed(tensor.shape), reversed(shape)):
+        pad += [0, target - size]
+    return F.pad(tensor, pad)
+
+
+def merge_memories(memories):
+    """
+    将多个样本的 encoder 输出 (第 0 维为 batch) 拼成一个 batch，
+    各样本的段落数和段落长度不同，按最大值用 0 补齐，补齐的位置在 attention 中都被 mask 掉
+    """
+    paths = [path for path, _ in _flatten(memories[0])]
+    values = list(zip(*[[value for _, value in _flatten(memory)] for memory in memories]))
+
+    merged = []
+    for path, tensors in zip(paths, values):
+        shape = [max(dims) for dims in zip(*[tensor.shape for tensor in tensors])]
+        merged.append((path, torch.cat([_pad_to(tensor, shape) for tensor in tensors], dim=0)))
+    return _unflatten(merged)
+
+
+class EncoderCache(object):
+    """
+    按 key (样本 id + 截断设置) 缓存单个样本的 encoder 输出和 decoder 的静态 K/V，
+    超过 max_entries 个条目或 max_bytes 字节时淘汰最久未使用的条目
+    """
+
+    def __init__(self, max_entries=128, max_bytes=1 << 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            memory = self.entries.get(key)
+            if memory is not None:
+                self.entries.move_to_end(key)
+            return memory
+
+    def put(self, key, memory):
+        n_bytes = memory_nbytes(memory)
+        if n_bytes > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= memory_nbytes(self.entries.pop(key))
+            self.entries[key] = memory
+            self.n_bytes += n_bytes
+
+            while len(self.entries) > self.max_entries or self.n_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.n_bytes -= memory_nbytes(evicted)
+
+    def __len__(self):
+        return len(self.entries)
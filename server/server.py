@@ -3,15 +3,21 @@ import json
 import glob
 import pickle
 import torch
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from flask import Flask, request
+from torch.utils.data import ConcatDataset
 
 sys.path.append('../src')
 
-from run import get_model, get_spm
+from run import get_inference_model, get_spm
 from models.predictor_builder import build_predictor
 from modules.data_loader import DataBatch
+from modules.memmap_dataset import MemmapDataset, example_to_json
 from utils.logger import init_logger, logger
+from utils.quantize import is_quantized
 from preprocess.lda.topic_model import TopicModel
+from batcher import MicroBatcher, QueueFullError
+from encoder_cache import EncoderCache, merge_memories
 
 app = Flask(__name__)
 app.jinja_env.auto_reload = True
@@ -23,9 +29,36 @@ checkpoint_path = '../models/tpt/model_step_200000.pt'
 prodlda_checkpoint_path = '../models/prodlda_src/prodlda_model.pt'
 model_name = 'TPT'
 data_path = '../../data/MultiNewsTopicAll'
+data_format = 'json'  # json / memmap
+# 合并并发请求的参数
+max_batch_size = 8
+max_wait_ms = 20
+max_queue_size = 64
+request_timeout = 300
+# 缓存 encoder 输出的条目数和字节数上限
+encoder_cache_entries = 256
+encoder_cache_bytes = 2 << 30
+# 词级 attention 只计算段落权重最大的 k 个段落，0 表示计算全部段落
+word_attn_top_k = 0
+# self-attention 的实现: default / sdpa
+attn_backend = 'default'
+# none / int8，int8 时对 nn.Linear 做动态量化，只支持 CPU。checkpoint_path 也可以直接是量化后保存的模型
+quantize = 'none'
+# 是否使用 bf16 混合精度推理，不能与 int8 量化同时使用
+bf16 = False
 
 
 def load_dataset():
+    if data_format == 'memmap':
+        # 按需从 memmap 中读取样本，不把整个测试集载入内存
+        pts = sorted(glob.glob(data_path + '/test/*.[0-1].bin'))
+        assert pts
+        datasets = []
+        for pt in pts:
+            datasets.append(MemmapDataset(pt))
+            logger.info('Loading dataset from %s, number of examples: %d' %
+                        (pt, len(datasets[-1])))
+        return ConcatDataset(datasets)
 
     def _dataset_loader(pt_file):
         file = json.load(open(pt_file))
@@ -42,6 +75,13 @@ def load_dataset():
     return dataset
 
 
+def get_example(index):
+    example = data[index]
+    if data_format == 'memmap':
+        example = example_to_json(example)
+    return example
+
+
 def get_prodlda_vocab(vocab_file):
     with open(vocab_file, 'rb') as file:
         vocab = pickle.load(file)
@@ -54,23 +94,73 @@ spm, symbols = get_spm(vocab_path)
 logger.info('Loading multi-document summarization model from %s' % checkpoint_path)
 checkpoint = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
 args = checkpoint['opt']
-args.batch_size = 1
+args.batch_size = max_batch_size
+# 推理时 query 很短，词级 attention 不需要分块
+args.word_attn_chunk_size = 0
+args.word_attn_top_k = word_attn_top_k
+args.attn_backend = attn_backend
+args.quantize = quantize
+args.bf16 = bf16
+if quantize == 'int8' or is_quantized(checkpoint):
+    device = 'cpu'
 
 prodlda_vocab = get_prodlda_vocab(prodlda_vocab_file)
 prodlda = TopicModel(prodlda_vocab, device, prodlda_checkpoint_path)
 
-model = get_model(args, symbols, spm, device, checkpoint)
-model.eval()
+model = get_inference_model(args, symbols, spm, device, checkpoint)
 predictor = build_predictor(args, spm, symbols, model, device)
 data = load_dataset()
 print(len(data))
 
 
+def make_batch(insts):
+    return DataBatch(args.n_heads, args.max_para_num, args.max_para_len,
+                     args.max_tgt_len, args.num_topic_words,
+                     data=insts, pad_idx=symbols['PAD'], device=device, is_test=True,
+                     pad_to_batch_max=True)
+
+
+def summarize(requests):
+    """
+    对合并后的多个请求做一次 beam search，已缓存的样本不再重新计算 encoder
+    :param requests: [(cache_key, inst)]
+    :return: 与 requests 一一对应的摘要
+    """
+    insts = [inst for _, inst in requests]
+
+    with torch.no_grad(), predictor.autocast():
+        memories = []
+        for key, inst in requests:
+            memory = encoder_cache.get(key)
+            if memory is None:
+                # 每个样本单独计算，缓存的张量只 pad 到样本自身的形状
+                memory = predictor.encode_memory(make_batch([inst]))
+                encoder_cache.put(key, memory)
+            memories.append(memory)
+
+        batch = make_batch(insts)
+        predictor.batch_size = batch.batch_size
+        results = predictor.translate_batch(batch, memory=merge_memories(memories))
+
+    pred_strs = []
+    for pred, gold, src in predictor.from_batch(results):
+        pred_str = ' '.join(pred).replace('<Q>', ' ').replace(' +', ' ') \
+            .replace('<unk>', 'UNK').replace('\\', '').strip()
+        pred_strs.append(pred_str)
+    logger.info('Summarized a batch of %d requests, %d encoder outputs cached' %
+                (len(requests), len(encoder_cache)))
+    return pred_strs
+
+
+encoder_cache = EncoderCache(encoder_cache_entries, encoder_cache_bytes)
+batcher = MicroBatcher(summarize, max_batch_size, max_wait_ms, max_queue_size)
+
+
 @app.route('/api/getData', methods=['GET'])
 def get_data():
     index = int(request.args.get('id'))
     n_topic_words = int(request.args.get('nTopicWords'))
-    example = data[index]
+    example = get_example(index)
 
     srcs = [spm.DecodeIds(src) for src in example['src']]
     topk_scores, topk_indices, topk_words = prodlda.get_srcs_topic_words(srcs, n_topic_words)
@@ -86,7 +176,7 @@ def predict():
     print(msg)
     topic_words, index = msg['topics'], int(msg['id'])
 
-    ex = data[index]
+    ex = get_example(index)
     src, tgt, tgt_str, graph, para_topic = \
         ex['src'], ex['tgt'], ex['tgt_str'], ex['sim_graph'], ex['src_topic']
 
@@ -102,17 +192,23 @@ def predict():
 
     tgt_topic = [spm.Encode(word)[0] for word in topic_words]
 
-    inst = [[src, tgt_ids, label_ids, tgt_str, graph, tgt_topic, para_topic]]
+    inst = [src, tgt_ids, label_ids, tgt_str, graph, tgt_topic, para_topic]
+
+    try:
+        # topic words 只影响 decoder，同一个样本的 encoder 输出可以复用
+        cache_key = (index, args.max_para_num, args.max_para_len)
+        future = batcher.submit((cache_key, inst))
+    except QueueFullError as e:
+        logger.warning(str(e))
+        return {'id': index, 'error': 'Server is busy, please retry later'}, 503
 
-    batch = DataBatch(args.n_heads, args.max_para_num, args.max_para_len,
-                      args.max_tgt_len, args.num_topic_words,
-                      data=inst, pad_idx=symbols['PAD'], device=device, is_test=True)
+    try:
+        pred_str = future.result(timeout=request_timeout)
+    except FutureTimeoutError:
+        # 还在排队的请求直接取消，不再解码；已经在解码的请求无法取消，结果被丢弃
+        future.cancel()
+        logger.warning('Request %d timed out after %d s' % (index, request_timeout))
+        return {'id': index, 'error': 'Request timed out, please retry later'}, 504
 
-    with torch.no_grad():
-        results = predictor.translate_batch(batch)
-    translation = predictor.from_batch(results)[0]
-    pred, gold, src = translation
-    pred_str = ' '.join(pred).replace('<Q>', ' ').replace(' +', ' ') \
-        .replace('<unk>', 'UNK').replace('\\', '').strip()
     print(pred_str)
     return {'id': index, 'summary': pred_str, 'topicWords': topic_words}
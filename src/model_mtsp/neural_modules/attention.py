@@ -9,7 +9,8 @@ from model_mtsp.neural_modules.attention_modules import ScaledDotProductAttentio
 
 class MultiHeadHierarchicalAttention(nn.Module):
 
-    def __init__(self, pos_win, d_k, d_v, d_model, device, n_heads=1, dropout=0, topic=None):
+    def __init__(self, pos_win, d_k, d_v, d_model, device, n_heads=1, dropout=0, topic=None,
+                 word_attn_chunk_size=None, word_attn_top_k=None):
         super(MultiHeadHierarchicalAttention, self).__init__()
         self.d_k = d_k
         self.d_v = d_v
@@ -34,7 +35,7 @@ class MultiHeadHierarchicalAttention(nn.Module):
         self.graph_attn = ScaledDotProductAttentionWithParaTopic(dropout, d_model, d_k, d_v, pos_win, self.device)
         self.topic_attn = ScaledDotProductAttention(dropout, d_k)
         self.attn_with_sent_norm = ScaledDotProductAttentionWithSentenceNorm(
-            dropout, d_model, d_k, d_v, n_heads
+            dropout, d_model, d_k, d_v, n_heads, chunk_size=word_attn_chunk_size, top_k=word_attn_top_k
         )
 
     def forward(self, q, k_s, v_s, k_w, v_w, bias_w, bias_s, graph_attn_bias,
@@ -45,9 +46,9 @@ class MultiHeadHierarchicalAttention(nn.Module):
         :param v_s: [batch_size, n_blocks, d_model]
         :param k_w: [batch_size, n_blocks, n_tokens, d_model]
         :param v_w: [batch_size, n_blocks, n_tokens, d_model]
-        :param bias_w: [batch_size, n_blocks, n_heads, seq_len, n_tokens]
-        :param bias_s: [batch_size, n_heads, seq_len, n_blocks]
-        :param graph_attn_bias: [batch_size, n_heads, n_blocks, n_blocks]
+        :param bias_w: bool mask [batch_size, n_blocks, 1, 1, n_tokens]
+        :param bias_s: bool mask [batch_size, 1, 1, n_blocks]
+        :param graph_attn_bias: [batch_size, 1, n_blocks, n_blocks]
         :param topic: []
         :param topic_attn_bias: []
         :param pt_attn: [batch_size, n_blocks, d_model]
@@ -22,7 +22,7 @@ class ScaledDotProductAttentionWithParaTopic(nn.Module):
         :param q: [batch_size, n_heads, len_q, dim_per_head]
         :param k: [batch_size, n_heads, len_k_s, dim_per_head]
         :param v: [batch_size, n_heads, len_v_s, dim_per_head]
-        :param bias: [batch_size, n_heads, len_q, len_k_s]
+        :param bias: bool mask [batch_size, 1, 1, len_k_s]
         :param pt_attn: [batch_size, n_heads, n_paras, dim_per_head]
         len_q = len_k = len_v = n_blocks
         d_k = d_v = dim_per_head
@@ -34,7 +34,7 @@ class ScaledDotProductAttentionWithParaTopic(nn.Module):
         # [batch_size, n_heads, len_q, len_k_s]
         attn = torch.matmul(scaled_q, k.transpose(2, 3))
         if bias is not None:
-            attn += bias
+            attn = attn.masked_fill(bias, torch.finfo(attn.dtype).min)
 
         # [batch_size, n_heads, len_q, len_k_s]
         weights = F.softmax(attn, dim=-1)
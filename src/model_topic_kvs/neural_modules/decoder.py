@@ -3,11 +3,13 @@ import torch.nn as nn
 from models.neural_modules.attention import MultiHeadAttention
 from model_topic_kvs.neural_modules.attention import MultiHeadHierarchicalAttention
 from models.neural_modules.neural_modules import PositionwiseFeedForward
+from models.neural_modules.kv_cache import KVCacheBuffer
 
 
 class GraphDecoderLayer(nn.Module):
 
-    def __init__(self, n_heads, d_model, d_k, d_v, d_inner_hidden, pos_win, dropout, device, topic=None):
+    def __init__(self, n_heads, d_model, d_k, d_v, d_inner_hidden, pos_win, dropout, device, topic=None,
+                 word_attn_chunk_size=None, word_attn_top_k=None, attn_backend='default', max_para_num=None):
         super(GraphDecoderLayer, self).__init__()
         self.topic = topic
         self.n_heads = n_heads
@@ -17,9 +19,11 @@ class GraphDecoderLayer(nn.Module):
         self.dropout1 = nn.Dropout(dropout)
         self.dropout2 = nn.Dropout(dropout)
 
-        self.self_attn = MultiHeadAttention(n_heads, d_model, d_k, d_v, dropout)
+        self.self_attn = MultiHeadAttention(n_heads, d_model, d_k, d_v, dropout, backend=attn_backend)
         self.multi_head_hierarchical_attn = MultiHeadHierarchicalAttention(
-            pos_win, d_k, d_v, d_model, device, n_heads, dropout, topic=topic
+            pos_win, d_k, d_v, d_model, device, n_heads, dropout, topic=topic,
+            word_attn_chunk_size=word_attn_chunk_size, word_attn_top_k=word_attn_top_k,
+            max_para_num=max_para_num
         )
 
         self.pos_ffd = PositionwiseFeedForward(d_model, d_inner_hidden, dropout)
@@ -34,12 +38,15 @@ class GraphDecoderLayer(nn.Module):
         self_attn_output = self.dropout1(self_attn_output) + dec_input
 
         q = self.layer_norm_2(self_attn_output)
-        # [batch_size, tgt_len, d_model]
+        # beam search 时 encoder 输出不按 beam 展开，各 beam 的 query 拼在一起共享同一份 memory
+        # [batch_size * beam_size, tgt_len, d_model] => [batch_size, beam_size * tgt_len, d_model]
+        q = q.view(enc_sents_output.size(0), -1, q.size(-1))
+        # [batch_size, beam_size * tgt_len, d_model]
         hier_attn_output = self.multi_head_hierarchical_attn(
             q, enc_sents_output, enc_sents_output, enc_words_output, enc_words_output,
             dec_enc_words_attn_bias, dec_enc_sents_attn_bias, graph_attn_bias,
             topic_embed_out, tgt_topic_attn_bias, cache=cache
-        )
+        ).view_as(self_attn_output)
         hier_attn_output = self.dropout2(hier_attn_output) + self_attn_output
 
         # [batch_size, len_q, d_model]
@@ -52,13 +59,16 @@ class GraphDecoderLayer(nn.Module):
 class GraphDecoder(nn.Module):
 
     def __init__(self, n_layers, n_heads, d_model, d_k, d_v, d_inner_hidden,
-                 pos_win, dropout, device):
+                 pos_win, dropout, device, word_attn_chunk_size=None, word_attn_top_k=None,
+                 attn_backend='default', max_para_num=None):
         super(GraphDecoder, self).__init__()
         self.n_layers = n_layers
 
         self.graph_decoder_layers = nn.ModuleList([
             GraphDecoderLayer(
-                n_heads, d_model, d_k, d_v, d_inner_hidden, pos_win, dropout, device
+                n_heads, d_model, d_k, d_v, d_inner_hidden, pos_win, dropout, device,
+                word_attn_chunk_size=word_attn_chunk_size, word_attn_top_k=word_attn_top_k,
+                attn_backend=attn_backend, max_para_num=max_para_num
             ) for _ in range(n_layers)
         ])
 
@@ -82,13 +92,17 @@ class GraphDecoder(nn.Module):
         # [batch_size, len_q, d_model]
         return dec_output
 
-    def init_decoder_state(self, with_cache=False):
+    def init_decoder_state(self, with_cache=False, max_len=None):
         state = GraphDecoderState()
         if with_cache:
-            state.init_cache(self.n_layers)
+            state.init_cache(self.n_layers, max_len)
         return state
 
 
+# 随 beam 的选择而变化的缓存
+BEAM_CACHE_KEYS = ('self_keys', 'self_values')
+
+
 class GraphDecoderState(object):
 
     def __init__(self):
@@ -96,14 +110,17 @@ class GraphDecoderState(object):
         self.previous_layer_inputs = None
         self.cache = None
 
-    def init_cache(self, num_layers):
+    def init_cache(self, num_layers, max_len=None):
+        """
+        :param max_len: 解码的最大步数，用于预分配 self-attention 的 K/V 缓存
+        """
         self.cache = {}
         for layer in range(num_layers):
             layer_cache = {
                 'memory_keys': None,
                 'memory_values': None,
-                'self_keys': None,
-                'self_values': None,
+                'self_keys': KVCacheBuffer(max_len),
+                'self_values': KVCacheBuffer(max_len),
                 'static_k_sent': None,
                 'static_v_sent': None,
                 'static_k_word': None,
@@ -113,13 +130,18 @@ class GraphDecoderState(object):
             }
             self.cache['layer_{}'.format(layer)] = layer_cache
 
-    def map_batch_fn(self, fn):
+    def map_batch_fn(self, fn, beam_only=False, source_only=False):
+        """
+        :param beam_only: 为 True 时只处理依赖 beam 历史的 self-attention 缓存 (第 0 维为 batch_size * beam_size)
+        :param source_only: 为 True 时只处理只依赖源文档的缓存，beam search 时同一个样本的各个 beam 共享
+            这些缓存 (第 0 维为 batch_size)，只在删除已完成的样本时才需要处理
+        """
         def _recursive_map(struct, batch_dim=0):
             for k, v in struct.items():
                 if v is not None:
                     if isinstance(v, dict):
                         _recursive_map(v)
-                    else:
+                    elif (k in BEAM_CACHE_KEYS and not source_only) or (k not in BEAM_CACHE_KEYS and not beam_only):
                         struct[k] = fn(v, batch_dim)
 
         if self.cache is not None:
@@ -6,6 +6,7 @@ from torch.nn.init import normal_
 from models.layers.encoder import TransformerEncoder, GraphEncoder
 from model_tpt.neural_modules.decoder import GraphDecoder
 from models.neural_modules.neural_modules import PositionalEncoding
+from utils.tensor_util import unpack
 
 
 class MDSTPT(nn.Module):
@@ -62,12 +63,12 @@ class MDSTPT(nn.Module):
             d_v=self.embed_size // self.n_heads,
             d_model=self.embed_size,
             d_inner_hidden=self.embed_size * 4,
-            dropout=self.dropout
+            dropout=self.dropout,
+            attn_backend=args.attn_backend
         )
         self.graph_encoder = GraphEncoder(
             n_graph_layers=self.enc_graph_layers,
             n_heads=self.n_heads,
-            n_blocks=self.max_para_num,
             d_model=self.embed_size,
             d_k=self.embed_size // self.n_heads,
             d_v=self.embed_size // self.n_heads,
@@ -87,6 +88,9 @@ class MDSTPT(nn.Module):
             pos_win=self.pos_win,
             dropout=self.dropout,
             device=device,
+            word_attn_chunk_size=args.word_attn_chunk_size,
+            word_attn_top_k=args.word_attn_top_k,
+            attn_backend=args.attn_backend,
         )
 
         self.generator_fc = nn.Linear(self.embed_size, self.vocab_size)
@@ -109,6 +113,8 @@ class MDSTPT(nn.Module):
     def encode(self, enc_input):
         src_word, src_word_pos, src_sent_pos, src_words_self_attn_bias, \
             src_sent_self_attn_bias, graph_attn_bias = enc_input
+        # 形状由当前 batch 决定，不要求 pad 到 max_para_num 和 max_para_len
+        n_blocks, n_tokens = src_word.size(1), src_word.size(2)
 
         # [batch_size, n_blocks, n_tokens, d_model]
         word_embed_out = self.enc_word_embed(src_word)
@@ -121,7 +127,7 @@ class MDSTPT(nn.Module):
         sent_pos_out = self.enc_pos_embed(src_sent_pos)
 
         # [batch_size, n_blocks, n_tokens, d_model / 2]
-        sent_pos_out = torch.unsqueeze(sent_pos_out, 2).expand(-1, -1, self.max_para_len, -1)
+        sent_pos_out = torch.unsqueeze(sent_pos_out, 2).expand(-1, -1, n_tokens, -1)
 
         # [batch_size, n_blocks, n_tokens, d_model]
         combined_pos_enc = torch.cat((word_pos_out, sent_pos_out), dim=-1)
@@ -131,32 +137,48 @@ class MDSTPT(nn.Module):
         embed_out = self.enc_embed_dropout(embed_out)
 
         # [batch_size * n_blocks, n_tokens, d_model]
-        embed_out = embed_out.contiguous().view(-1, self.max_para_len, self.embed_size)
+        embed_out = embed_out.contiguous().view(-1, n_tokens, self.embed_size)
 
-        # [batch_size * n_blocks, n_heads, n_tokens, n_tokens]
-        src_words_self_attn_bias = src_words_self_attn_bias.contiguous().view(
-            -1, self.n_heads, self.max_para_len, self.max_para_len
-        )
+        # [batch_size * n_blocks, 1, 1, n_tokens]
+        src_words_self_attn_bias = src_words_self_attn_bias.contiguous().view(-1, 1, 1, n_tokens)
 
-        # [batch_size * n_blocks, n_tokens, d_model]
+        # 不足 n_blocks 个段落的样本补了空段落，只编码真实的段落
+        # [batch_size, n_blocks]
+        para_mask = ~src_sent_self_attn_bias.view(-1, n_blocks)
+        if para_mask.all():
+            para_mask = None
+        else:
+            # [n_paras, n_tokens, d_model] [n_paras, 1, 1, n_tokens]
+            embed_out = embed_out[para_mask.view(-1)]
+            src_words_self_attn_bias = src_words_self_attn_bias[para_mask.view(-1)]
+
+        # [batch_size * n_blocks (n_paras), n_tokens, d_model]
         enc_words_out = self.transformer_encoder(embed_out, src_words_self_attn_bias)
 
         # [batch_size, n_blocks, d_model]
         enc_sents_out = self.graph_encoder(
-            enc_words_out, src_words_self_attn_bias, src_sent_self_attn_bias, graph_attn_bias
+            enc_words_out, src_words_self_attn_bias, src_sent_self_attn_bias, graph_attn_bias, para_mask
         )
 
         enc_words_out = self.enc_layer_norm(enc_words_out)
 
         # [batch_size, n_blocks, n_tokens, d_model]
-        enc_words_out = enc_words_out.contiguous().view(
-            -1, self.max_para_num, self.max_para_len, self.embed_size
-        )
+        if para_mask is not None:
+            # 空段落的位置补 0，在 decoder 中会被 mask 掉
+            enc_words_out = unpack(enc_words_out, para_mask)
+        else:
+            enc_words_out = enc_words_out.contiguous().view(
+                -1, n_blocks, n_tokens, self.embed_size
+            )
 
         # [batch_size, n_blocks, n_tokens, d_model] [batch_size, n_blocks, d_model]
         return enc_words_out, enc_sents_out
 
-    def decode(self, dec_input, enc_words_out, enc_sents_out, state=None):
+    def decode(self, dec_input, enc_words_out, enc_sents_out, state=None, generate=True):
+        """
+        :param generate: 为 False 时不经过 generator，返回 decoder 的输出 [batch_size * tgt_len, d_model]，
+            由 loss 分块调用 generate 计算 log 概率
+        """
         tgt_word, tgt_pos, tgt_self_attn_bias, tgt_src_words_attn_bias, tgt_src_sents_attn_bias,\
             graph_attn_bias, tgt_topic, tgt_topic_attn_bias, para_topic, para_topic_attn_bias = dec_input
 
@@ -184,16 +206,23 @@ class MDSTPT(nn.Module):
 
         # [batch_size * tgt_len, d_model]
         dec_output = dec_output.contiguous().view(-1, self.embed_size)
+        if not generate:
+            return dec_output
 
         # [batch_size * tgt_len, vocab_size]
-        predict = self.generator_fc(dec_output)
-        predict = self.generator_log_softmax(predict)
+        return self.generate(dec_output)
 
-        # [batch_size * tgt_len, vocab_size]
-        return predict
+    def generate(self, dec_output):
+        """
+        :param dec_output: [n, d_model]
+        :return: log 概率 [n, vocab_size]
+        """
+        predict = self.generator_fc(dec_output)
+        # 混合精度下 log_softmax 和 loss 仍在 fp32 下计算
+        return self.generator_log_softmax(predict.float())
 
-    def forward(self, enc_input, dec_input):
+    def forward(self, enc_input, dec_input, generate=True):
         enc_words_out, enc_sents_out = self.encode(enc_input)
-        dec_out = self.decode(dec_input, enc_words_out, enc_sents_out)
+        dec_out = self.decode(dec_input, enc_words_out, enc_sents_out, generate=generate)
 
         return dec_out
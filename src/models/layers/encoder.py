@@ -3,16 +3,17 @@ import torch.nn as nn
 from models.neural_modules.attention import \
     MultiHeadAttention, MultiHeadPooling, MultiHeadStructureAttention
 from models.neural_modules.neural_modules import PositionwiseFeedForward
+from utils.tensor_util import unpack
 
 
 class TransformerEncoderLayer(nn.Module):
 
-    def __init__(self, d_model, n_heads, d_k, d_v, d_inner_hidden, dropout):
+    def __init__(self, d_model, n_heads, d_k, d_v, d_inner_hidden, dropout, attn_backend='default'):
         super(TransformerEncoderLayer, self).__init__()
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.dropout = nn.Dropout(dropout)
 
-        self.self_attn = MultiHeadAttention(n_heads, d_model, d_k, d_v, dropout)
+        self.self_attn = MultiHeadAttention(n_heads, d_model, d_k, d_v, dropout, backend=attn_backend)
         self.pos_ffd = PositionwiseFeedForward(d_model, d_inner_hidden, dropout)
 
     def forward(self, k, bias):
@@ -36,19 +37,19 @@ class TransformerEncoderLayer(nn.Module):
 
 class TransformerEncoder(nn.Module):
 
-    def __init__(self, n_layers, n_heads, d_k, d_v, d_model, d_inner_hidden, dropout):
+    def __init__(self, n_layers, n_heads, d_k, d_v, d_model, d_inner_hidden, dropout, attn_backend='default'):
         super(TransformerEncoder, self).__init__()
         self.n_layers = n_layers
 
         self.transformer_encoder_layers = nn.ModuleList(
-            [TransformerEncoderLayer(d_model, n_heads, d_k, d_v, d_inner_hidden, dropout)
+            [TransformerEncoderLayer(d_model, n_heads, d_k, d_v, d_inner_hidden, dropout, attn_backend)
              for _ in range(self.n_layers)]
         )
 
     def forward(self, enc_input, bias):
         """
         :param enc_input: [batch_size, n_blocks, d_model]
-        :param bias: [batch_size * n_blocks, n_heads, n_tokens, n_tokens]
+        :param bias: [batch_size * n_blocks, 1, 1, n_tokens]
         :return: [batch_size, n_blocks, d_model]
         """
         for i in range(self.n_layers):
@@ -61,9 +62,8 @@ class TransformerEncoder(nn.Module):
 
 class SelfAttentionPoolingLayer(nn.Module):
 
-    def __init__(self, n_heads, d_model, d_v, n_blocks, dropout):
+    def __init__(self, n_heads, d_model, d_v, dropout):
         super(SelfAttentionPoolingLayer, self).__init__()
-        self.n_blocks = n_blocks
         self.d_model = d_model
 
         self.multi_head_pooling = MultiHeadPooling(n_heads, d_model, d_v, dropout)
@@ -71,18 +71,24 @@ class SelfAttentionPoolingLayer(nn.Module):
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, enc_input, bias):
+    def forward(self, enc_input, bias, n_blocks, para_mask=None):
         """
-        :param enc_input: [batch_size * n_blocks, n_tokens, d_model]
-        :param bias: [batch_size * n_blocks, n_heads, n_tokens, n_tokens]
+        :param enc_input: [batch_size * n_blocks, n_tokens, d_model]，给出 para_mask 时为 [n_paras, n_tokens, d_model]
+        :param bias: [batch_size * n_blocks, 1, 1, n_tokens]，给出 para_mask 时为 [n_paras, 1, 1, n_tokens]
+        :param n_blocks: 当前 batch 的段落数
+        :param para_mask: [batch_size, n_blocks]，enc_input 只包含 para_mask 为 True 的真实段落
         :return: [batch_size, n_blocks, d_model]
         """
         key = self.layer_norm(enc_input)
 
         # [batch_size * n_blocks, d_model]
         attn_output = self.multi_head_pooling(key, key, bias)
-        # [batch_size, n_blocks, d_model]
-        attn_output = attn_output.contiguous().view(-1, self.n_blocks, self.d_model)
+        if para_mask is not None:
+            # 空段落的位置补 0 [batch_size, n_blocks, d_model]
+            attn_output = unpack(attn_output, para_mask)
+        else:
+            # [batch_size, n_blocks, d_model]
+            attn_output = attn_output.contiguous().view(-1, n_blocks, self.d_model)
 
         pooling_output = self.dropout(attn_output)
 
@@ -105,8 +111,8 @@ class GraphEncoderLayer(nn.Module):
     def forward(self, enc_input, bias, graph_attn_bias):
         """
         :param enc_input: [batch_size, n_blocks, d_model]
-        :param bias: [batch_size, n_heads, n_blocks, n_blocks]
-        :param graph_attn_bias: [batch_size, n_heads, n_blocks, n_blocks]
+        :param bias: [batch_size, 1, 1, n_blocks]
+        :param graph_attn_bias: [batch_size, 1, n_blocks, n_blocks]
         :return: [batch_size, n_blocks, d_model]
         """
         q = self.layer_norm(enc_input)
@@ -123,7 +129,7 @@ class GraphEncoderLayer(nn.Module):
 
 class GraphEncoder(nn.Module):
 
-    def __init__(self, n_graph_layers, n_heads, n_blocks,
+    def __init__(self, n_graph_layers, n_heads,
                  d_model, d_k, d_v, d_inner_hidden, pos_win, dropout):
         super(GraphEncoder, self).__init__()
         self.n_graph_layers = n_graph_layers
@@ -131,7 +137,7 @@ class GraphEncoder(nn.Module):
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
         self.self_attn_pooling_layer = SelfAttentionPoolingLayer(
-            n_heads, d_model, d_v, n_blocks, dropout
+            n_heads, d_model, d_v, dropout
         )
         self.graph_encoder_layers = nn.ModuleList(
             [GraphEncoderLayer(
@@ -140,16 +146,19 @@ class GraphEncoder(nn.Module):
         )
 
     def forward(self, enc_words_input, src_words_self_attn_bias,
-                src_sents_self_attn_bias, graph_attn_bias):
+                src_sents_self_attn_bias, graph_attn_bias, para_mask=None):
         """
-        :param enc_words_input: [batch_size * n_blocks, n_tokens, d_model]
-        :param src_words_self_attn_bias: [batch_size * n_blocks, n_heads, n_tokens, n_tokens]
-        :param src_sents_self_attn_bias: [batch_size, n_heads, n_blocks, n_blocks]
-        :param graph_attn_bias:
+        :param enc_words_input: [batch_size * n_blocks, n_tokens, d_model]，给出 para_mask 时为 [n_paras, n_tokens, d_model]
+        :param src_words_self_attn_bias: [batch_size * n_blocks, 1, 1, n_tokens]，给出 para_mask 时为 [n_paras, 1, 1, n_tokens]
+        :param src_sents_self_attn_bias: [batch_size, 1, 1, n_blocks]
+        :param graph_attn_bias: [batch_size, 1, n_blocks, n_blocks]
+        :param para_mask: [batch_size, n_blocks]，enc_words_input 只包含 para_mask 为 True 的真实段落
         :return: [batch_size, n_blocks, d_model]
         """
         # [batch_size, n_blocks, d_model]
-        enc_input = self.self_attn_pooling_layer(enc_words_input, src_words_self_attn_bias)
+        enc_input = self.self_attn_pooling_layer(
+            enc_words_input, src_words_self_attn_bias, src_sents_self_attn_bias.size(-1), para_mask
+        )
 
         for i in range(self.n_graph_layers):
             # [batch_size, n_blocks, d_model]
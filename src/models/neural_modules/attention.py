@@ -14,26 +14,79 @@ class MultiHeadAttention(nn.Module):
     多头注意力是通过 transpose 和 reshape 实现的，而不是真的拆分张量
     In practice, the multi-headed attention are done with transposes and reshapes
     rather than actual separate tensors.
+
+    backend 为 'sdpa' 时 Q/K/V 的投影合并为一个 Linear (w_qkv)，self-attention 只做一次矩阵乘法，
+    并调用 F.scaled_dot_product_attention 计算 attention。
+    两种 backend 的 checkpoint 在加载时自动拼接或拆分投影的参数，可以互相加载
     """
-    def __init__(self, n_heads, d_model, d_k, d_v, dropout=0):
+    def __init__(self, n_heads, d_model, d_k, d_v, dropout=0, backend='default'):
         super(MultiHeadAttention, self).__init__()
         self.d_k = d_k
         self.d_v = d_v
         self.n_heads = n_heads
+        self.backend = backend
 
-        self.w_qs = nn.Linear(d_model, n_heads * d_k)
-        self.w_ks = nn.Linear(d_model, n_heads * d_k)
-        self.w_vs = nn.Linear(d_model, n_heads * d_v)
+        if backend == 'sdpa':
+            # [Q; K; V] 的投影
+            self.w_qkv = nn.Linear(d_model, n_heads * (2 * d_k + d_v))
+        else:
+            self.w_qs = nn.Linear(d_model, n_heads * d_k)
+            self.w_ks = nn.Linear(d_model, n_heads * d_k)
+            self.w_vs = nn.Linear(d_model, n_heads * d_v)
         self.fc = nn.Linear(d_model, d_model)
 
         self.attn = ScaledDotProductAttention(dropout, d_k)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容另一种 backend 保存的 checkpoint
+        split_keys = [prefix + 'w_qs.', prefix + 'w_ks.', prefix + 'w_vs.']
+        fused_key = prefix + 'w_qkv.'
+        for name in ('weight', 'bias'):
+            if self.backend == 'sdpa' and split_keys[0] + name in state_dict:
+                state_dict[fused_key + name] = torch.cat([state_dict.pop(key + name) for key in split_keys], dim=0)
+            elif self.backend != 'sdpa' and fused_key + name in state_dict:
+                fused = state_dict.pop(fused_key + name)
+                sizes = [self.n_heads * self.d_k, self.n_heads * self.d_k, self.n_heads * self.d_v]
+                for key, value in zip(split_keys, fused.split(sizes, dim=0)):
+                    state_dict[key + name] = value
+        super(MultiHeadAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _project_q(self, q):
+        if self.backend != 'sdpa':
+            return self.w_qs(q)
+        n_q = self.n_heads * self.d_k
+        if not isinstance(self.w_qkv, nn.Linear):
+            # 动态量化后的 Linear 不能按行切分权重
+            return self.w_qkv(q)[..., :n_q]
+        return F.linear(q, self.w_qkv.weight[:n_q], self.w_qkv.bias[:n_q])
+
+    def _project(self, q, k, v):
+        if self.backend != 'sdpa':
+            return self.w_qs(q), self.w_ks(k), self.w_vs(v)
+
+        sizes = [self.n_heads * self.d_k, self.n_heads * self.d_k, self.n_heads * self.d_v]
+        if q is k and k is v:
+            # self-attention 一次算出 Q/K/V
+            return self.w_qkv(q).split(sizes, dim=-1)
+        if not isinstance(self.w_qkv, nn.Linear):
+            # 动态量化后的 Linear 不能按行切分权重
+            return self._project_q(q), self.w_qkv(k).split(sizes, dim=-1)[1], self.w_qkv(v).split(sizes, dim=-1)[2]
+
+        weights = self.w_qkv.weight.split(sizes, dim=0)
+        biases = self.w_qkv.bias.split(sizes, dim=0)
+        q = F.linear(q, weights[0], biases[0])
+        if k is v:
+            k, v = F.linear(k, torch.cat(weights[1:]), torch.cat(biases[1:])).split(sizes[1:], dim=-1)
+        else:
+            k, v = F.linear(k, weights[1], biases[1]), F.linear(v, weights[2], biases[2])
+        return q, k, v
+
     def forward(self, q, k, v, bias, cache=None, type=None):
         """
         :param q: [batch_size, seq_len, d_model]
         :param k: [batch_size, len_k, d_model]
         :param v: [batch_size, len_v, d_model]
-        :param bias: [batch_size, n_heads, len_q, len_k]
+        :param bias: bool mask [batch_size, 1, len_q or 1, len_k]
         :return: [batch_size, len_q, d_model] [batch_size, n_heads, len_q, len_k]
         d_model = num_heads * d_k
         """
@@ -52,34 +105,41 @@ class MultiHeadAttention(nn.Module):
 
         if cache is not None:
             if type == 'self':
-                q, k, v = self.w_qs(q), self.w_ks(k), self.w_vs(v)
+                q, k, v = self._project(q, k, v)
                 k, v = shape(k), shape(v)
 
-                device = k.device
-                if cache['self_keys'] is not None:
-                    k = torch.cat([cache['self_keys'].to(device), k], dim=2)
-                if cache['self_values'] is not None:
-                    v = torch.cat([cache['self_values'].to(device), v], dim=2)
-                cache['self_keys'] = k
-                cache['self_values'] = v
+                # 写入预分配的缓存，得到到当前步为止的 K/V
+                # [batch_size, n_heads, cur_len, dim_per_head]
+                k = cache['self_keys'].append(k)
+                v = cache['self_values'].append(v)
             elif type == 'context':
-                q = self.w_qs(q)
                 if cache['memory_keys'] is None:
-                    k, v = self.w_ks(k), self.w_vs(v)
+                    q, k, v = self._project(q, k, v)
                     k = shape(k)
                     v = shape(v)
                 else:
+                    q = self._project_q(q)
                     k, v = cache['memory_keys'], cache['memory_values']
                 cache['memory_keys'] = k
                 cache['memory_values'] = v
         else:
-            q, k, v = self.w_qs(q), self.w_ks(k), self.w_vs(v)
+            q, k, v = self._project(q, k, v)
             k, v = shape(k), shape(v)
 
         q = shape(q)
 
         # [batch_size, n_heads, len_q, d_v]
-        out, _ = self.attn(q, k, v, bias)
+        if self.backend == 'sdpa':
+            attn_mask = None
+            if bias is not None:
+                # 用加性 mask 保持与 masked_fill 相同的语义 (全部被 mask 的行为均匀分布)，
+                # 取当前精度的最小值，bf16 下不会溢出
+                attn_mask = torch.zeros(bias.shape, dtype=q.dtype, device=q.device) \
+                    .masked_fill(bias, torch.finfo(q.dtype).min)
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                                 dropout_p=self.attn.dropout.p if self.training else 0.0)
+        else:
+            out, _ = self.attn(q, k, v, bias)
 
         # [batch_size, len_q, d_model]
         out = unshape(out)
@@ -106,7 +166,7 @@ class MultiHeadPooling(nn.Module):
         """
         :param k: [batch_size, len_k, d_model]
         :param v: [batch_size, len_v, d_model]
-        :param bias: [batch_size, n_heads, len_k ,len_k]
+        :param bias: bool mask [batch_size, 1, 1, len_k]
         """
         batch_size, d_v, n_heads = k.size(0), self.d_v, self.n_heads
         # [batch_size, len_k, n_heads, 1]
@@ -150,8 +210,8 @@ class MultiHeadStructureAttention(nn.Module):
         :param q: [batch_size, len_q, d_model]
         :param k: [batch_size, len_k, d_model]
         :param v: [batch_size, len_v, d_model]
-        :param bias: [batch_size, n_heads, n_blocks, n_blocks]
-        :param graph_attn_bias: [batch_size, n_heads, n_blocks, n_blocks]
+        :param bias: bool mask [batch_size, 1, 1, n_blocks]
+        :param graph_attn_bias: [batch_size, 1, n_blocks, n_blocks]
         d_model = num_heads * d_k = n_heads * d_v
         len_q = len_k = len_v = n_blocks
         """
@@ -181,7 +241,8 @@ class MultiHeadStructureAttention(nn.Module):
 
 class MultiHeadHierarchicalAttention(nn.Module):
 
-    def __init__(self, pos_win, d_k, d_v, d_model, device, n_heads=1, dropout=0, topic=None):
+    def __init__(self, pos_win, d_k, d_v, d_model, device, n_heads=1, dropout=0, topic=None,
+                 word_attn_chunk_size=None, word_attn_top_k=None, max_para_num=None):
         super(MultiHeadHierarchicalAttention, self).__init__()
         self.d_k = d_k
         self.d_v = d_v
@@ -198,9 +259,11 @@ class MultiHeadHierarchicalAttention(nn.Module):
         self.w_vs_w = nn.Linear(d_model, n_heads * d_v)
         self.fc = nn.Linear(2 * d_model, d_model)
 
-        self.graph_attn = GraphScaledDotProductAttentionWithMask(dropout, d_model, d_k, d_v, pos_win, self.device)
+        self.graph_attn = GraphScaledDotProductAttentionWithMask(
+            dropout, d_model, d_k, d_v, pos_win, self.device, max_para_num=max_para_num
+        )
         self.attn_with_sent_norm = ScaledDotProductAttentionWithSentenceNorm(
-            dropout, d_model, d_k, d_v, n_heads
+            dropout, d_model, d_k, d_v, n_heads, chunk_size=word_attn_chunk_size, top_k=word_attn_top_k
         )
 
     def forward(self, q, k_s, v_s, k_w, v_w, bias_w, bias_s, graph_attn_bias, cache=None):
@@ -210,9 +273,9 @@ class MultiHeadHierarchicalAttention(nn.Module):
         :param v_s: [batch_size, n_blocks, d_model]
         :param k_w: [batch_size, n_blocks, n_tokens, d_model]
         :param v_w: [batch_size, n_blocks, n_tokens, d_model]
-        :param bias_w: [batch_size, n_blocks, n_heads, seq_len, n_tokens]
-        :param bias_s: [batch_size, n_heads, seq_len, n_blocks]
-        :param graph_attn_bias: [batch_size, n_heads, n_blocks, n_blocks]
+        :param bias_w: bool mask [batch_size, n_blocks, 1, 1, n_tokens]
+        :param bias_s: bool mask [batch_size, 1, 1, n_blocks]
+        :param graph_attn_bias: [batch_size, 1, n_blocks, n_blocks]
         :param cache:
         :return: [batch_size, len_q, d_model]
         d_model = dim_embed = n_heads * d_k = n_heads * d_v
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class ScaledDotProductAttention(nn.Module):
@@ -15,14 +16,14 @@ class ScaledDotProductAttention(nn.Module):
         :param q: [batch_size, n_heads, len_q, dim_per_head]
         :param k: [batch_size, n_heads, len_k, dim_per_head]
         :param v: [batch_size, n_heads, len_v, dim_per_head]
-        :param bias: [batch_size, n_heads, len_q, len_k]
+        :param bias: bool mask, True 表示 padding [batch_size, 1, len_q or 1, len_k]
         :return:
         """
         # [batch_size, n_heads, len_q, len_k]
         attn = torch.matmul(q / (self.d_k ** 0.5), k.transpose(2, 3))
 
         if bias is not None:
-            attn += bias
+            attn = attn.masked_fill(bias, torch.finfo(attn.dtype).min)
 
         # [batch_size, n_heads, len_q, len_k]
         weights = self.dropout(F.softmax(attn, dim=-1))
@@ -41,15 +42,14 @@ class DotProductPooling(nn.Module):
         """
         :param k: [batch_size, n_heads, len_k, 1]
         :param v: [batch_size, n_heads, len_v, d_v]
-        :param bias: [batch_size, n_heads, len_k, len_k]
+        :param bias: bool mask [batch_size, 1, 1, len_k]
         len_k = len_v
         """
         # [batch_size, n_heads, len_k]
         product = k.squeeze(-1)
         if bias is not None:
-            # [batch_size, n_heads, 1, len_k]
-            bias_sliced = bias[:, :, 0, :]
-            product += bias_sliced.squeeze(2)
+            # [batch_size, 1, len_k]
+            product = product.masked_fill(bias[:, :, 0, :], torch.finfo(product.dtype).min)
 
         # [batch_size, n_heads, len_k]
         weights = self.dropout(F.softmax(product, dim=-1))
@@ -74,22 +74,23 @@ class GraphScaledDotProductAttention(nn.Module):
         :param q: [batch_size, n_heads, len_q, d_k]
         :param k: [batch_size, n_heads, len_k, d_k]
         :param v: [batch_size, n_heads, len_v, d_v]
-        :param bias: [batch_size, n_heads, len_q, len_k]
-        :param graph_attn_bias: [batch_size, n_heads, len_q, len_k]
+        :param bias: bool mask [batch_size, 1, 1, len_k]
+        :param graph_attn_bias: [batch_size, 1, len_q, len_k]
         len_q = len_k = len_v = n_blocks
         d_k = d_v = dim_per_head
         """
         scaled_q = q / (self.d_k ** 0.5)
         # [batch_size, n_heads, len_q, len_k]
         attn = torch.matmul(scaled_q, k.transpose(2, 3))
-        if bias is not None:
-            attn += bias
 
         if graph_attn_bias is not None:
-            # [batch_size, n_heads, len_q, len_k]
+            # [batch_size, 1, len_q, len_k]
             gaussian_w = (-0.5 * (graph_attn_bias * graph_attn_bias)) / ((0.5 * self.pos_win) ** 2)
             attn += gaussian_w
 
+        if bias is not None:
+            attn = attn.masked_fill(bias, torch.finfo(attn.dtype).min)
+
         weights = self.dropout(F.softmax(attn, dim=-1))
 
         # [batch_size, n_heads, len_q, d_v]
@@ -99,13 +100,18 @@ class GraphScaledDotProductAttention(nn.Module):
 
 class GraphScaledDotProductAttentionWithMask(nn.Module):
 
-    def __init__(self, dropout, d_model, d_k, d_v, pos_win, device):
+    def __init__(self, dropout, d_model, d_k, d_v, pos_win, device, max_para_num=None):
+        """
+        :param max_para_num: pos 的取值范围为 [0, max_para_num - 1]，与 batch 中实际的段落数无关，
+                             为 None 时按当前 batch 的 n_blocks 缩放
+        """
         super(GraphScaledDotProductAttentionWithMask, self).__init__()
         self.dropout = nn.Dropout(dropout)
         self.d_k = d_k
         self.pos_win = pos_win
         self.d_model = d_model
         self.device = device
+        self.max_para_num = max_para_num
 
         self.fc_pos_v = nn.Linear(d_k, d_v)
         self.fc_pos_s = nn.Linear(d_v, 1)
@@ -116,8 +122,8 @@ class GraphScaledDotProductAttentionWithMask(nn.Module):
         :param q: [batch_size, n_heads, len_q, dim_per_head]
         :param k: [batch_size, n_heads, len_k_s, dim_per_head]
         :param v: [batch_size, n_heads, len_v_s, dim_per_head]
-        :param bias: [batch_size, n_heads, len_q, len_k_s]
-        :param graph_attn_bias: [batch_size, n_heads, len_k_s, len_k_s]
+        :param bias: bool mask [batch_size, 1, 1, len_k_s]
+        :param graph_attn_bias: [batch_size, 1, len_k_s, len_k_s]
         len_q = len_k = len_v = n_blocks
         d_k = d_v = dim_per_head
         """
@@ -127,8 +133,6 @@ class GraphScaledDotProductAttentionWithMask(nn.Module):
         scaled_q = q / (self.d_k ** 0.5)
         # [batch_size, n_heads, len_q, len_k_s]
         attn = torch.matmul(scaled_q, k.transpose(2, 3))
-        if bias is not None:
-            attn += bias
 
         if graph_attn_bias is not None:
             # [batch_size, n_heads, len_q, d_v]
@@ -136,50 +140,20 @@ class GraphScaledDotProductAttentionWithMask(nn.Module):
             # [batch_size, n_heads, len_q, 1]
             pos_s = self.fc_pos_s(torch.tanh(pos_v))
             # pos 表示摘要 q 中的每个单词关注的段落，由于段落为整数，所以分为了 pos_up 和 pos_down
-            pos = torch.sigmoid(pos_s) * (len_k_s - 1)
-
-            # [batch_size, n_heads, len_q, 1]
-            pos_up = torch.ceil(pos).to(torch.int64)
-            pos_down = torch.floor(pos).to(torch.int64)
-
-            batch_ind = torch.arange(0, batch_size, 1, dtype=torch.int64, device=self.device)
-            # [batch_size, n_heads, len_q, 1]
-            batch_ind = batch_ind.view(batch_size, 1, 1, 1).expand(-1, n_heads, len_q, -1)
-
-            head_ind = torch.arange(0, n_heads, 1, dtype=torch.int64, device=self.device)
-            # [batch_size, n_heads, len_q, 1]
-            head_ind = head_ind.view(1, n_heads, 1, 1).expand(batch_size, -1, len_q, -1)
-
-            query_ind = torch.arange(start=0, end=len_q, step=1, dtype=torch.int64, device=self.device)
-            # [batch_size, n_heads, len_q, 1]
-            query_ind = query_ind.view(1, 1, len_q, 1).expand(batch_size, n_heads, -1, -1)
-
-            # [batch_size, n_heads, len_q, 4]
-            pos_up_ind = torch.cat((batch_ind, head_ind, query_ind, pos_up), dim=3).to(self.device)
-            pos_up_ind.requires_grad_(requires_grad=False)
-            pos_down_ind = torch.cat((batch_ind, head_ind, query_ind, pos_down), dim=3).to(self.device)
-            pos_down_ind.requires_grad_(requires_grad=False)
-
-            # [batch_size, n_heads, len_q, len_k_s, len_k_s]
-            graph_attn_mask = torch.unsqueeze(graph_attn_bias, dim=2)
-            graph_attn_mask = graph_attn_mask.expand(-1, -1, len_q, -1, -1)
+            # 按配置的 max_para_num 而不是 batch 内的 n_blocks 缩放，使 pos 不受同一 batch 中其他样本的影响
+            max_para_num = self.max_para_num or len_k_s
+            pos = torch.sigmoid(pos_s) * (max_para_num - 1)
 
-            pos_up_ind = pos_up_ind.permute(3, 0, 1, 2)
-            pos_down_ind = pos_down_ind.permute(3, 0, 1, 2)
-            # 将 pos_up/pos_down 中对应的中心段落与其他段落的相似度，作为摘要与其他段落的相似度
             # [batch_size, n_heads, len_q, len_k_s]
-            graph_attn_mask_up = graph_attn_mask[list(pos_up_ind)]
-            graph_attn_mask_down = graph_attn_mask[list(pos_down_ind)]
-
-            # 将 pos_up/pos_down 与 pos 的距离作为权重，加权得到最终的 graph_attn_mask
-            # [batch_size, n_heads, len_q, len_k_s]
-            graph_attn_mask_select = graph_attn_mask_up * (1.0 - (pos_up.to(torch.float32) - pos)) + \
-                graph_attn_mask_down * (1.0 - (pos - pos_down.to(torch.float32)))
+            graph_attn_mask_select = self._select_graph_attn_mask(graph_attn_bias.expand(-1, n_heads, -1, -1), pos)
 
             gaussian_w = (-0.5 * graph_attn_mask_select * graph_attn_mask_select) / ((0.5 * self.pos_win) ** 2)
 
             attn += gaussian_w
 
+        if bias is not None:
+            attn = attn.masked_fill(bias, torch.finfo(attn.dtype).min)
+
         # [batch_size, n_heads, len_q, len_k_s]
         weights = self.dropout(F.softmax(attn, dim=-1))
 
@@ -192,15 +166,50 @@ class GraphScaledDotProductAttentionWithMask(nn.Module):
         # [batch_size, len_q, d_model] [batch_size, n_heads, len_q, len_k_s]
         return graph_out, weights
 
+    @staticmethod
+    def _select_graph_attn_mask(graph_attn_mask, pos):
+        """
+        将 pos_up/pos_down 中对应的中心段落与其他段落的相似度，按与 pos 的距离加权，作为摘要与其他段落的相似度
+        直接在 [batch_size, n_heads, len_k_s, len_k_s] 上按行 gather，不展开 len_q 维；
+        pos 超出 n_blocks 时取 padding 段落对应的行，即 pad 到 max_para_num 时该行的值 1.0
+        :param graph_attn_mask: [batch_size, n_heads, len_k_s, len_k_s]
+        :param pos: [batch_size, n_heads, len_q, 1]
+        :return: [batch_size, n_heads, len_q, len_k_s]
+        """
+        len_k_s = graph_attn_mask.size(2)
+
+        # [batch_size, n_heads, len_q, 1]
+        pos_up = torch.ceil(pos).to(torch.int64)
+        pos_down = torch.floor(pos).to(torch.int64)
+
+        def select(index):
+            # [batch_size, n_heads, len_q, len_k_s]
+            rows = graph_attn_mask.gather(2, index.clamp(max=len_k_s - 1).expand(-1, -1, -1, len_k_s))
+            return rows.masked_fill(index >= len_k_s, 1.0)
+
+        # [batch_size, n_heads, len_q, len_k_s]
+        return select(pos_up) * (1.0 - (pos_up.to(torch.float32) - pos)) + \
+            select(pos_down) * (1.0 - (pos - pos_down.to(torch.float32)))
+
 
 class ScaledDotProductAttentionWithSentenceNorm(nn.Module):
 
-    def __init__(self, dropout, d_model, d_k, d_v, n_heads):
+    def __init__(self, dropout, d_model, d_k, d_v, n_heads, chunk_size=None, top_k=None):
+        """
+        :param chunk_size: 每次计算的段落数，为 None 或 0 时一次计算全部段落
+        :param top_k: 推理时每个 query 只在段落权重最大的 top_k 个段落内计算词级 attention，为 None 或 0 时不启用
+        """
         super(ScaledDotProductAttentionWithSentenceNorm, self).__init__()
         self.dropout = nn.Dropout(dropout)
         self.d_k = d_k
         self.n_heads = n_heads
         self.d_v = d_v
+        self.chunk_size = chunk_size
+        self.top_k = top_k
+
+        # top_k 近似时被丢弃的段落权重之和及其统计次数，用于衡量近似误差
+        self.dropped_mass = 0.0
+        self.n_dropped = 0
 
         self.fc = nn.Linear(d_model, d_model)
 
@@ -210,18 +219,34 @@ class ScaledDotProductAttentionWithSentenceNorm(nn.Module):
         :param k: [batch_size, n_blocks, n_heads, n_tokens, dim_per_head]
         :param v: [batch_size, n_blocks, n_heads, n_tokens, dim_per_head]
         :param attn_s: [batch_size, n_heads, len_q, n_blocks]
-        :param bias: [batch_size, n_blocks, n_heads, len_q, n_tokens]
+        :param bias: bool mask [batch_size, n_blocks, 1, 1, n_tokens]
+        :return: [batch_size, len_q, d_model]
+            [batch_size, n_heads, len_q, len_k * n_tokens] (分块计算时为 None)
         """
         batch_size, len_q, len_k = q.size(0), q.size(2), k.size(1)
         d_v, n_heads = self.d_v, self.n_heads
 
+        if self.top_k and self.top_k < len_k and not self.training:
+            # [batch_size, n_heads, len_q, d_v]
+            out = self._top_k_attn(q, k, v, attn_s, bias)
+            # [batch_size, len_q, n_heads * d_v]
+            out = out.transpose(1, 2).contiguous().view(batch_size, len_q, -1)
+            return self.fc(out), None
+
+        if self.chunk_size and self.chunk_size < len_k:
+            # [batch_size, n_heads, len_q, d_v]
+            out = self._chunked_attn(q, k, v, attn_s, bias)
+            # [batch_size, len_q, n_heads * d_v]
+            out = out.transpose(1, 2).contiguous().view(batch_size, len_q, -1)
+            return self.fc(out), None
+
         # [batch_size, len_k, n_heads, len_q, d_k]
         q = q.unsqueeze(1).expand(-1, len_k, -1, -1, -1)
         # [batch_size, len_k, n_heads, len_q, n_tokens]
         attn = torch.matmul(q / (self.d_k ** 0.5), k.transpose(3, 4))
 
         if bias is not None:
-            attn += bias
+            attn = attn.masked_fill(bias, torch.finfo(attn.dtype).min)
 
         weights = F.softmax(attn, dim=-1)
 
@@ -246,3 +271,94 @@ class ScaledDotProductAttentionWithSentenceNorm(nn.Module):
 
         # [batch_size, len_q, d_model] [batch_size, n_heads, len_q, len_k * n_tokens]
         return out, attn_w
+
+    def _top_k_attn(self, q, k, v, attn_s, bias):
+        """
+        每个 query 只保留 attn_s 最大的 top_k 个段落，在这些段落的词上计算 attention，
+        保留的段落权重重新归一化。被丢弃的段落权重之和累加到 dropped_mass 中，
+        输出与完整计算的误差不超过 2 * dropped_mass * max(|context|)
+        :return: [batch_size, n_heads, len_q, d_v]
+        """
+        batch_size, n_heads, len_q = q.size(0), q.size(1), q.size(2)
+        len_k, n_tokens, top_k = k.size(1), k.size(3), self.top_k
+
+        # [batch_size, n_heads, len_q, top_k]
+        top_s, top_ind = attn_s.topk(top_k, dim=-1)
+        top_s_sum = top_s.sum(dim=-1, keepdim=True)
+        self.dropped_mass = self.dropped_mass + (1.0 - top_s_sum).sum()
+        self.n_dropped += top_s_sum.numel()
+        top_s = top_s / top_s_sum
+
+        def select(x):
+            # [batch_size, n_blocks, n_heads, n_tokens, dim] => [batch_size, n_heads, len_q, top_k, n_tokens, dim]
+            x = x.transpose(1, 2).reshape(batch_size, n_heads, len_k, -1)
+            ind = top_ind.view(batch_size, n_heads, -1, 1).expand(-1, -1, -1, x.size(-1))
+            return x.gather(2, ind).view(batch_size, n_heads, len_q, top_k, n_tokens, -1)
+
+        k, v = select(k), select(v)
+
+        # [batch_size, n_heads, len_q, top_k, n_tokens]
+        attn = torch.matmul(k, (q / (self.d_k ** 0.5)).unsqueeze(3).unsqueeze(-1)).squeeze(-1)
+
+        if bias is not None:
+            # [batch_size, n_heads, len_k, n_tokens]
+            bias = bias.view(batch_size, 1, len_k, n_tokens).expand(-1, n_heads, -1, -1)
+            ind = top_ind.view(batch_size, n_heads, -1, 1).expand(-1, -1, -1, n_tokens)
+            attn = attn.masked_fill(bias.gather(2, ind).view_as(attn), torch.finfo(attn.dtype).min)
+
+        # [batch_size, n_heads, len_q, top_k, n_tokens]
+        weights = F.softmax(attn, dim=-1) * top_s.unsqueeze(-1)
+
+        # [batch_size, n_heads, len_q, 1, top_k * n_tokens] x [batch_size, n_heads, len_q, top_k * n_tokens, d_v]
+        out = torch.matmul(weights.view(batch_size, n_heads, len_q, 1, -1),
+                           v.view(batch_size, n_heads, len_q, top_k * n_tokens, -1))
+
+        # [batch_size, n_heads, len_q, d_v]
+        return out.squeeze(3)
+
+    def _chunked_attn(self, q, k, v, attn_s, bias):
+        """
+        每个段落内部单独做 softmax，段落之间只是按 attn_s 加权求和，
+        所以可以每次只计算 chunk_size 个段落并累加结果，不需要保存全部段落的 attention 权重。
+        训练时对每一块做 checkpoint，反向传播时重新计算该块，峰值显存只与 chunk_size 有关
+        :return: [batch_size, n_heads, len_q, d_v]
+        """
+        use_checkpoint = torch.is_grad_enabled() and \
+            any(x.requires_grad for x in (q, k, v, attn_s))
+
+        out = None
+        for start in range(0, k.size(1), self.chunk_size):
+            end = start + self.chunk_size
+            chunk_bias = bias[:, start:end] if bias is not None else None
+            inputs = (q, k[:, start:end], v[:, start:end], attn_s[:, :, :, start:end], chunk_bias)
+            if use_checkpoint:
+                chunk_out = checkpoint(self._attn_chunk, *inputs, use_reentrant=False)
+            else:
+                chunk_out = self._attn_chunk(*inputs)
+            out = chunk_out if out is None else out + chunk_out
+
+        return out
+
+    def _attn_chunk(self, q, k, v, attn_s, bias):
+        """
+        :param q: [batch_size, n_heads, len_q, d_k]
+        :param k: [batch_size, chunk_size, n_heads, n_tokens, d_k]
+        :param v: [batch_size, chunk_size, n_heads, n_tokens, d_v]
+        :param attn_s: [batch_size, n_heads, len_q, chunk_size]
+        :param bias: bool mask [batch_size, chunk_size, 1, 1, n_tokens]
+        :return: [batch_size, n_heads, len_q, d_v]
+        """
+        # q 在段落维上广播，不需要 expand
+        # [batch_size, chunk_size, n_heads, len_q, n_tokens]
+        attn = torch.matmul((q / (self.d_k ** 0.5)).unsqueeze(1), k.transpose(3, 4))
+
+        if bias is not None:
+            attn = attn.masked_fill(bias, torch.finfo(attn.dtype).min)
+
+        weights = F.softmax(attn, dim=-1)
+        # 乘上段落级的权重 [batch_size, chunk_size, n_heads, len_q, 1]
+        weights = weights * attn_s.permute(0, 3, 1, 2).unsqueeze(-1)
+        weights = self.dropout(weights)
+
+        # [batch_size, n_heads, len_q, d_v]
+        return torch.matmul(weights, v).sum(dim=1)
@@ -0,0 +1,54 @@
+import torch
+
+
+class KVCacheBuffer(object):
+    """
+    解码时 self-attention 的 K 或 V 缓存，预分配 [batch_size, n_heads, max_len, dim_per_head] 的张量，
+    每一步原地写入当前位置，避免每一步 torch.cat 重新分配并拷贝全部历史
+    """
+
+    def __init__(self, max_len=None):
+        # max_len 为 None 时按需成倍扩容
+        self.max_len = max_len
+        self.length = 0
+        self.buffer = None
+        # beam 重排时 gather 到备用张量，再与 buffer 交换
+        self._spare = None
+
+    def _capacity(self, length):
+        if self.max_len is not None and length <= self.max_len:
+            return self.max_len
+        capacity = 16 if self.buffer is None else self.buffer.size(2)
+        while capacity < length:
+            capacity *= 2
+        return capacity
+
+    def append(self, x):
+        """
+        :param x: [batch_size, n_heads, len, dim_per_head]
+        :return: 到当前步为止的视图 [batch_size, n_heads, length, dim_per_head]
+        """
+        length = self.length + x.size(2)
+        if self.buffer is None or length > self.buffer.size(2):
+            buffer = x.new_empty([x.size(0), x.size(1), self._capacity(length), x.size(3)])
+            if self.buffer is not None:
+                buffer[:, :, :self.length] = self.buffer[:, :, :self.length]
+            self.buffer, self._spare = buffer, None
+
+        self.buffer[:, :, self.length:length] = x
+        self.length = length
+        return self.buffer[:, :, :length]
+
+    def index_select(self, dim, indices):
+        """
+        按 indices 重排 batch 维，与 GraphDecoderState.map_batch_fn 配合使用
+        """
+        assert dim == 0
+        if self.buffer is None:
+            return self
+
+        if self._spare is None or self._spare.size(0) != indices.size(0):
+            self._spare = self.buffer.new_empty([indices.size(0)] + list(self.buffer.shape[1:]))
+        torch.index_select(self.buffer[:, :, :self.length], 0, indices, out=self._spare[:, :, :self.length])
+        self.buffer, self._spare = self._spare, self.buffer
+        return self
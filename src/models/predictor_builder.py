@@ -5,10 +5,16 @@ from tqdm import tqdm
 from tensorboardX import SummaryWriter
 
 from utils.logger import logger
-from utils.tensor_util import tile
 from modules.data_loader import get_num_examples
 from utils.cal_rouge import rouge_results_to_str, test_rouge
 from utils.beam_search import BeamSearch
+from utils.trigram_blocker import TrigramBlocker
+from utils.tensor_util import autocast
+from models.neural_modules.attention_modules import ScaledDotProductAttentionWithSentenceNorm
+
+
+# decoder cache 中只依赖 encoder 输出的 K/V 投影
+STATIC_CACHE_KEYS = ('static_k_sent', 'static_v_sent', 'static_k_word', 'static_v_word')
 
 
 def build_predictor(args, tokenizer, symbols, model, device):
@@ -47,6 +53,12 @@ class Translator(object):
         self.id2is_full_token = [self.vocab.IdToPiece(token_id).startswith('▁')
                                  for token_id in range(len(self.vocab))]
 
+    def autocast(self):
+        """
+        encode_memory / translate_batch / translate_b 需要在这个上下文中调用，--bf16 时使用 bf16 混合精度
+        """
+        return autocast(self.device, self.args.bf16)
+
     def translate(self, test_iter, step):
         logger.info('Start predicting')
         self.model.eval()
@@ -62,8 +74,9 @@ class Translator(object):
         raw_candi_file = open(raw_candi_path, 'w', encoding='utf-8')
         raw_src_file = open(raw_src_path, 'w', encoding='utf-8')
 
-        with torch.no_grad():
-            total = math.ceil(get_num_examples(self.args.data_path, self.args.mode) / self.batch_size)
+        with torch.no_grad(), self.autocast():
+            total = math.ceil(get_num_examples(self.args.data_path, 'test', self.args.data_format)
+                              / self.batch_size)
             for batch in tqdm(test_iter, total=total):
                 self.batch_size = batch.batch_size
                 batch_data = self.translate_batch(batch, self.n_best)
@@ -95,6 +108,10 @@ class Translator(object):
         gold_file.close()
         raw_src_file.close()
 
+        if self.args.word_attn_top_k:
+            self._report_sparse_attn(step)
+
+        rouges = None
         if step != -1 and self.args.report_rouge:
             rouges = self._report_rouge(gold_path, candi_path)
             logger.info(rouges)
@@ -104,36 +121,64 @@ class Translator(object):
                 self.writer.add_scalar('test/rouge2-F', rouges['rouge_2_f_score'], step)
                 self.writer.add_scalar('test/rougeL-F', rouges['rouge_l_f_score'], step)
 
-    def translate_batch(self, batch, n_best=1):
+        return rouges
+
+    def encode_memory(self, batch):
+        """
+        计算 encoder 的输出，以及 decoder 各层中只依赖 encoder 输出 (与 topic words 无关) 的 K/V 投影，
+        结果可以缓存下来，通过 translate_batch 的 memory 参数重复使用
+        :return: {'enc_words_output': [batch_size, n_blocks, n_tokens, d_model],
+                  'enc_sents_output': [batch_size, n_blocks, d_model],
+                  'static_cache': {layer: {key: [batch_size, ...]}}}
+        """
+        enc_input, dec_input = batch.enc_input, batch.dec_input
+        _, _, _, src_words_self_attn_bias, src_sents_self_attn_bias, graph_attn_bias = enc_input
+
+        enc_words_output, enc_sents_output = self.model.encode(enc_input)
+
+        # 解码一步 <BOS>，decoder 的 cache 中就保存了各层的静态 K/V
+        dec_state = self.model.graph_decoder.init_decoder_state(with_cache=True, max_len=1)
+        pre_ids = torch.full([batch.batch_size, 1], self.bos_idx, dtype=torch.int64, device=self.device)
+        pre_pos = torch.zeros_like(pre_ids)
+        step_input = (pre_ids, pre_pos, None, src_words_self_attn_bias, src_sents_self_attn_bias,
+                      graph_attn_bias) + tuple(dec_input[6:])
+        self.model.decode(step_input, enc_words_output, enc_sents_output, dec_state)
+
+        static_cache = {layer: {key: layer_cache[key] for key in STATIC_CACHE_KEYS}
+                        for layer, layer_cache in dec_state.cache.items()}
+
+        return {'enc_words_output': enc_words_output, 'enc_sents_output': enc_sents_output,
+                'static_cache': static_cache}
+
+    def translate_batch(self, batch, n_best=1, memory=None):
+        """
+        :param memory: encode_memory 的输出，为 None 时重新计算 encoder
+        """
         batch_size = self.batch_size
         beam_size = self.beam_size
 
         enc_input, dec_input = batch.enc_input, batch.dec_input
         _, _, _, src_words_self_attn_bias, src_sents_self_attn_bias, graph_attn_bias = enc_input
         tgt_topic, tgt_topic_attn_bias, para_topic, para_topic_attn_bias = dec_input[6:]
-        tgt_topic = tile(tgt_topic, beam_size, 0)
-        tgt_topic_attn_bias = tile(tgt_topic_attn_bias[:, :, 0].unsqueeze(2), beam_size, 0)
-        para_topic = tile(para_topic, beam_size, 0)
-        para_topic_attn_bias = tile(para_topic_attn_bias, beam_size, 0)
-
-        # [batch_size, max_para_num, n_heads, 1, max_para_len]
-        tgt_src_words_attn_bias = src_words_self_attn_bias[:, :, :, 0].unsqueeze(3)
-        tgt_src_words_attn_bias.requires_grad = False
-        # [batch_size, n_heads, 1, max_para_num]
-        tgt_src_sents_attn_bias = src_sents_self_attn_bias[:, :, 0].unsqueeze(2)
-        tgt_src_sents_attn_bias.requires_grad = False
-
-        # 拿到 encoder 的输出，并展开 beam_size 维度
-        enc_words_output, enc_sents_output = self.model.encode(enc_input)
-        enc_words_output = tile(enc_words_output, beam_size, 0)
-        enc_sents_output = tile(enc_sents_output, beam_size, 0)
 
-        dec_state = self.model.graph_decoder.init_decoder_state(with_cache=True)
+        # 拿到 encoder 的输出，各 beam 共享同一份，不展开 beam_size 维度
+        if memory is None:
+            enc_words_output, enc_sents_output = self.model.encode(enc_input)
+        else:
+            enc_words_output, enc_sents_output = memory['enc_words_output'], memory['enc_sents_output']
+
+        dec_state = self.model.graph_decoder.init_decoder_state(with_cache=True, max_len=self.max_out_len)
+        if memory is not None:
+            for layer, layer_cache in memory['static_cache'].items():
+                dec_state.cache[layer].update(layer_cache)
 
         batch_offset = torch.arange(batch_size, dtype=torch.int64, device=self.device)
         beam_offset = torch.arange(0, batch_size * beam_size, step=beam_size, dtype=torch.int64, device=self.device)
 
         alive_seq = torch.full([batch_size * beam_size, 1], self.bos_idx, dtype=torch.int64, device=self.device)
+        if self.blocking_trigram:
+            trigram_blocker = TrigramBlocker(self.id2is_full_token, self.space_idx, batch_size * beam_size,
+                                            self.bos_idx, self.device)
 
         # 初始化时，第一个 beam 的概率为 1
         topk_log_probs = torch.tensor([0.0] + [float('-inf')] * (beam_size - 1), device=self.device).repeat(batch_size)
@@ -146,10 +191,11 @@ class Translator(object):
             'gold_score': [0] * batch_size,
             'batch': batch
         }
-        # [batch_size * beam_size, 1]
-        pre_src_words_attn_bias = tile(tgt_src_words_attn_bias, beam_size, 0)
-        pre_src_sents_attn_bias = tile(tgt_src_sents_attn_bias, beam_size, 0)
-        pre_graph_attn_bias = tile(graph_attn_bias, beam_size, 0)
+        # [batch_size, max_para_num, 1, 1, max_para_len]
+        pre_src_words_attn_bias = src_words_self_attn_bias
+        # [batch_size, 1, 1, max_para_num]
+        pre_src_sents_attn_bias = src_sents_self_attn_bias
+        pre_graph_attn_bias = graph_attn_bias
 
         for step in range(self.max_out_len):
             pre_ids = alive_seq[:, -1].view(-1, 1)
@@ -170,11 +216,8 @@ class Translator(object):
             topk_vocab_scores, topk_vocab_indices = logits.topk(beam_size, dim=-1)
 
             if self.blocking_trigram:
-                expand_alive_seq = alive_seq.unsqueeze(1).expand(-1, beam_size, -1)
-                # [batch_size * beam_size, beam_size, step + 1]
-                candi_seqs = torch.cat([expand_alive_seq, topk_vocab_indices.unsqueeze(-1)], dim=-1)
                 # [batch_size * beam_size, beam_size]
-                mask_block_trigram = self.block_trigram(candi_seqs)
+                mask_block_trigram = trigram_blocker.block_mask(topk_vocab_indices)
                 # [batch_size * beam_size, beam_size]
                 pre_scores = topk_log_probs.view(-1).unsqueeze(-1) + mask_block_trigram
 
@@ -206,6 +249,8 @@ class Translator(object):
             select_indices = batch_index.view(-1)
 
             alive_seq = torch.cat([alive_seq.index_select(0, select_indices), topk_ids.view(-1, 1)], -1)
+            if self.blocking_trigram:
+                trigram_blocker.advance(select_indices, topk_ids.view(-1))
 
             # [batch_size, beam_size]
             is_finished = topk_ids.view(-1, beam_size).eq(self.eos_idx)
@@ -240,17 +285,30 @@ class Translator(object):
                 batch_index = batch_index.index_select(0, non_finished)
                 batch_offset = batch_offset.index_select(0, non_finished)
                 alive_seq = predictions.index_select(0, non_finished).view(-1, alive_seq.size(-1))
+                if self.blocking_trigram:
+                    # [len(non_finished) * beam_size]
+                    keep_hyps = (non_finished.unsqueeze(1) * beam_size +
+                                 torch.arange(beam_size, device=non_finished.device)).view(-1)
+                    trigram_blocker.reorder(keep_hyps)
 
                 # 有 batch 完成时，将不会再对其预测
                 select_indices = batch_index.view(-1)
-                enc_words_output = enc_words_output.index_select(0, select_indices)
-                enc_sents_output = enc_sents_output.index_select(0, select_indices)
-                pre_src_words_attn_bias = pre_src_words_attn_bias.index_select(0, select_indices)
-                pre_src_sents_attn_bias = pre_src_sents_attn_bias.index_select(0, select_indices)
-                tgt_topic = tgt_topic.index_select(0, select_indices)
-                tgt_topic_attn_bias = tgt_topic_attn_bias.index_select(0, select_indices)
-
-            dec_state.map_batch_fn(lambda state, dim: state.index_select(dim, select_indices))
+                if len(non_finished) < end_condition.size(0):
+                    # 源文档相关的张量第 0 维为 batch_size，按样本压缩
+                    enc_words_output = enc_words_output.index_select(0, non_finished)
+                    enc_sents_output = enc_sents_output.index_select(0, non_finished)
+                    pre_src_words_attn_bias = pre_src_words_attn_bias.index_select(0, non_finished)
+                    pre_src_sents_attn_bias = pre_src_sents_attn_bias.index_select(0, non_finished)
+                    pre_graph_attn_bias = pre_graph_attn_bias.index_select(0, non_finished)
+                    tgt_topic = tgt_topic.index_select(0, non_finished)
+                    tgt_topic_attn_bias = tgt_topic_attn_bias.index_select(0, non_finished)
+                    para_topic = para_topic.index_select(0, non_finished)
+                    para_topic_attn_bias = para_topic_attn_bias.index_select(0, non_finished)
+                    dec_state.map_batch_fn(lambda state, dim: state.index_select(dim, non_finished),
+                                           source_only=True)
+
+            # 每一步只有 self-attention 的缓存需要按选中的 beam 重排
+            dec_state.map_batch_fn(lambda state, dim: state.index_select(dim, select_indices), beam_only=True)
 
         return results
 
@@ -260,34 +318,28 @@ class Translator(object):
         enc_input, dec_input = batch.enc_input, batch.dec_input
         _, _, _, src_words_self_attn_bias, src_sents_self_attn_bias, graph_attn_bias = enc_input
         tgt_topic, tgt_topic_attn_bias = dec_input[6:8]
-        tgt_topic = tile(tgt_topic, beam_size, 0)
-        tgt_topic_attn_bias = tile(tgt_topic_attn_bias[:, :, 0].unsqueeze(2), beam_size, 0)
 
-        # [batch_size, max_para_num, n_heads, 1, max_para_len]
-        tgt_src_words_attn_bias = src_words_self_attn_bias[:, :, :, 0].unsqueeze(3)
-        tgt_src_words_attn_bias.requires_grad = False
-        # [batch_size, n_heads, 1, max_para_num]
-        tgt_src_sents_attn_bias = src_sents_self_attn_bias[:, :, 0].unsqueeze(2)
-        tgt_src_sents_attn_bias.requires_grad = False
-
-        # 拿到 encoder 的输出，并展开 beam_size 维度
+        # 拿到 encoder 的输出，各 beam 共享同一份，不展开 beam_size 维度
         enc_words_output, enc_sents_output = self.model.encode(enc_input)
-        enc_words_output = tile(enc_words_output, beam_size, 0)
-        enc_sents_output = tile(enc_sents_output, beam_size, 0)
 
-        dec_state = self.model.graph_decoder.init_decoder_state(with_cache=True)
+        dec_state = self.model.graph_decoder.init_decoder_state(with_cache=True, max_len=self.max_out_len)
 
         alive_seq = torch.full([batch_size * beam_size, 1], self.bos_idx, dtype=torch.int64, device=self.device)
         batch_beam_size, cur_len = alive_seq.size()
+        if self.blocking_trigram:
+            trigram_blocker = TrigramBlocker(self.id2is_full_token, self.space_idx, batch_beam_size,
+                                            self.bos_idx, self.device)
+        beam_offset = torch.arange(0, batch_beam_size, step=beam_size, dtype=torch.int64, device=self.device)
 
         beam_scores = torch.zeros([batch_size, beam_size], dtype=torch.float, device=self.device)
         beam_scores[:, 1:] = -1e20
         beam_scores = beam_scores.view(-1)
 
-        # [batch_size * beam_size, 1]
-        pre_src_words_attn_bias = tile(tgt_src_words_attn_bias, beam_size, 0)
-        pre_src_sents_attn_bias = tile(tgt_src_sents_attn_bias, beam_size, 0)
-        pre_graph_attn_bias = tile(graph_attn_bias, beam_size, 0)
+        # [batch_size, max_para_num, 1, 1, max_para_len]
+        pre_src_words_attn_bias = src_words_self_attn_bias
+        # [batch_size, 1, 1, max_para_num]
+        pre_src_sents_attn_bias = src_sents_self_attn_bias
+        pre_graph_attn_bias = graph_attn_bias
 
         beam_search = BeamSearch(batch_size, self.max_out_len, beam_size, n_best, self.length_penalty, self.device)
 
@@ -312,12 +364,10 @@ class Translator(object):
             next_tokens = next_tokens % vocab_size
 
             if self.blocking_trigram:
-                # [batch_size, 2 * beam_size, cur_len]
-                expand_alive_seq = alive_seq.view(-1, beam_size, cur_len).gather(1, next_indices.unsqueeze(-1).expand(-1, -1, cur_len))
-                # [batch_size, 2 * beam_size, cur_len + 1]
-                candi_seqs = torch.cat([expand_alive_seq, next_tokens.unsqueeze(-1)], dim=-1)
+                # 候选在 batch_size * beam_size 中所属的假设 [batch_size, 2 * beam_size]
+                candi_parents = next_indices + beam_offset.unsqueeze(1)
                 # [batch_size, 2 * beam_size]
-                mask_block_trigram = self.block_trigram(candi_seqs)
+                mask_block_trigram = trigram_blocker.block_mask(next_tokens, candi_parents)
                 # [batch_size, 2 * beam_size]
                 next_token_scores = next_token_scores + mask_block_trigram
 
@@ -329,9 +379,12 @@ class Translator(object):
                 beam_outputs['next_beam_scores'], beam_outputs['next_beam_tokens'], beam_outputs['next_beam_indices']
 
             alive_seq = torch.cat([alive_seq[beam_indices, :], beam_next_tokens.unsqueeze(-1)], dim=-1)
+            if self.blocking_trigram:
+                trigram_blocker.advance(beam_indices, beam_next_tokens)
 
             cur_len += 1
-            dec_state.map_batch_fn(lambda state, dim: state.index_select(dim, beam_indices))
+            # 已完成的 batch 不会被删除，源文档相关的缓存不需要重排
+            dec_state.map_batch_fn(lambda state, dim: state.index_select(dim, beam_indices), beam_only=True)
 
             if beam_search.is_done:
                 break
@@ -381,55 +434,28 @@ class Translator(object):
         tokens = self.vocab.DecodeIds(tokens).split(' ')
         return tokens
 
+    def _report_sparse_attn(self, step):
+        """
+        统计 top-k 段落词级 attention 的近似误差：平均每个 (query, head) 被丢弃的段落 attention 权重
+        """
+        modules = [module for module in self.model.modules()
+                   if isinstance(module, ScaledDotProductAttentionWithSentenceNorm) and module.n_dropped > 0]
+        if not modules:
+            return
+
+        dropped_mass = sum(float(module.dropped_mass) for module in modules) / \
+            sum(module.n_dropped for module in modules)
+        for module in modules:
+            module.dropped_mass, module.n_dropped = 0.0, 0
+
+        logger.info('Word attention on top %d paragraphs, mean dropped paragraph attention %.6f'
+                    % (self.args.word_attn_top_k, dropped_mass))
+        if step != -1 and self.writer is not None:
+            self.writer.add_scalar('test/word_attn_dropped_mass', dropped_mass, step)
+
     def _report_rouge(self, gold_path, candi_path):
         logger.info('Calculating Rouge')
         candidates = open(candi_path, encoding='utf-8')
         references = open(gold_path, encoding='utf-8')
         result_dict = test_rouge(candidates, references, 8)
         return result_dict
-
-    def block_trigram(self, candi_seq):
-        """
-        :param candi_seq: [batch_size * beam_size, beam_size, len]
-        """
-        def _sub_token_id2full_tokens(sub_token_indices):
-            full_tokens = []
-            pre_is_space = False
-            for sub_token_id in sub_token_indices.cpu().numpy().tolist():
-                is_full_token = self.id2is_full_token[sub_token_id]
-                if sub_token_id == self.space_idx:
-                    pre_is_space = True
-                    continue
-                if is_full_token or not full_tokens or pre_is_space:
-                    full_tokens.append([sub_token_id])
-                else:
-                    pre_full_token = full_tokens[-1]
-                    pre_full_token.append(sub_token_id)
-                pre_is_space = False
-
-            full_tokens = ['-'.join(map(str, full_token)) for full_token in full_tokens]
-            return full_tokens
-
-        def _make_trigram_str(trigram_tokens):
-            return '_'.join(trigram_tokens)
-
-        delta_list = []
-        for beam in candi_seq:
-            delta_scores = []
-            for seq in beam:
-                sub_token_ids = seq.view(-1)
-                tokens = _sub_token_id2full_tokens(sub_token_ids)
-                if len(tokens) <= 3:
-                    delta_scores.append(0)
-                    continue
-                trigrams = [_make_trigram_str(tokens[end - 3: end]) for end in range(3, len(tokens))]
-                trigrams_set = set(trigrams)
-                last_trigram = _make_trigram_str(tokens[-3:])
-                if last_trigram in trigrams_set:
-                    # 重复的 trigram
-                    delta_scores.append(-1e20)
-                else:
-                    delta_scores.append(0)
-            delta_list.append(delta_scores)
-        # [batch_size * beam_size, beam_size]
-        return torch.tensor(delta_list, dtype=torch.float, device=self.device)
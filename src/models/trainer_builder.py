@@ -1,10 +1,15 @@
 import os
+import contextlib
 import torch
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 
 from modules.loss import build_loss_compute
 from utils.logger import logger
 from utils.statistics import Statistics
 from utils.report_manager import build_report_manager
+from utils.tensor_util import autocast
+from utils.distributed import is_distributed, is_master, get_world_size, all_reduce_sum, barrier
 
 
 def build_trainer(args, device, model, symbols, vocab_size, optim, get_test_iter):
@@ -13,9 +18,26 @@ def build_trainer(args, device, model, symbols, vocab_size, optim, get_test_iter
 
     shard_size = args.max_generator_batches
 
-    tensorboard_log_dir = args.model_path + '/tensorboard'
-    report_manager = build_report_manager(args.report_every, tensorboard_log_dir)
-    trainer = Trainer(args, model, optim, shard_size, train_loss, valid_loss, get_test_iter, report_manager)
+    # 只有 rank 0 写 tensorboard 和输出训练日志
+    report_manager = None
+    if is_master():
+        tensorboard_log_dir = args.model_path + '/tensorboard'
+        report_manager = build_report_manager(args.report_every, tensorboard_log_dir)
+
+    # chunked_loss 时 generator 和 loss 也在 train_model 的 forward 中计算，DDP 能看到 generator 的参数
+    train_model = None
+    if args.chunked_loss:
+        train_model = ChunkedLossModel(model, train_loss, shard_size, args.bf16)
+
+    # 分布式训练时前向和反向通过 DDP，保存和验证仍使用原来的 model
+    if is_distributed():
+        device_ids = [torch.device(device)] if torch.device(device).type == 'cuda' else None
+        # TransformerEncoder 只有最后一层的输出被使用，TPT 中也有不参与计算的模块，这些参数没有梯度
+        train_model = DistributedDataParallel(train_model if train_model is not None else model,
+                                              device_ids=device_ids, find_unused_parameters=True)
+
+    trainer = Trainer(args, model, optim, shard_size, train_loss, valid_loss, get_test_iter, report_manager,
+                      train_model=train_model)
 
     n_params = sum([p.nelement() for p in model.parameters()])
     enc, dec = 0, 0
@@ -31,18 +53,49 @@ def build_trainer(args, device, model, symbols, vocab_size, optim, get_test_iter
     return trainer
 
 
+class ChunkedLossModel(nn.Module):
+    """
+    chunked_loss 时 decoder、generator 和 loss 一起作为训练时的 forward，返回 loss 之和与统计量
+    """
+
+    def __init__(self, model, loss_compute, chunk_size, bf16=False):
+        super(ChunkedLossModel, self).__init__()
+        self.model = model
+        self.loss_compute = loss_compute
+        self.chunk_size = chunk_size
+        self.bf16 = bf16
+
+    def forward(self, enc_input, dec_input, tgt_label):
+        # 只有模型在 autocast 下计算，loss 在 autocast 之外
+        with autocast(enc_input[0].device, self.bf16):
+            # 模型只输出 decoder 的结果，generator 在 loss 中分块计算
+            dec_output = self.model(enc_input, dec_input, generate=False)
+
+        def generator(dec_output_chunk):
+            with autocast(dec_output_chunk.device, self.bf16):
+                return self.model.generate(dec_output_chunk)
+
+        return self.loss_compute.chunked_compute_loss(tgt_label, dec_output, generator, self.chunk_size)
+
+
 class Trainer(object):
 
     def __init__(self, args, model, optim, shard_size, train_loss, valid_loss,
-                 get_test_iter=None, report_manager=None):
+                 get_test_iter=None, report_manager=None, train_model=None):
+        """
+        :param train_model: 训练时使用的模型 (ChunkedLossModel / DistributedDataParallel)，为 None 时使用 model
+        """
         self.args = args
         self.model = model
+        self.train_model = train_model if train_model is not None else model
+        self.world_size = get_world_size()
         self.train_loss = train_loss
         self.valid_loss = valid_loss
         self.optim = optim
         self.shard_size = shard_size
         self.report_manager = report_manager
         self.get_test_iter = get_test_iter
+        self.accum_count = args.accum_count
 
     def train(self, train_iter_fct, train_steps):
         logger.info('Start training...')
@@ -54,18 +107,40 @@ class Trainer(object):
         report_stats = Statistics()
         self._start_report_manager(start_time=total_stats.start_time)
 
+        true_batchs = []
+        accum = 0
+        normalization = 0
         while step <= train_steps:
             for i, batch in enumerate(train_iter):
-                self.model.train()
-                num_tokens = batch.tgt_label.ne(self.train_loss.padding_idx).sum()
-                normalization = num_tokens.item()
-                self._gradient_accumulation(batch, normalization, total_stats, report_stats)
+                true_batchs.append(batch)
+                # 保留为 device 上的张量，不调用 .item() 同步
+                normalization = normalization + batch.tgt_label.ne(self.train_loss.padding_idx).sum()
+                accum += 1
+                if accum < self.accum_count:
+                    continue
+
+                if self.world_size > 1:
+                    # DDP 对各进程的梯度取平均，loss 除以所有进程的词数之和 / world_size，
+                    # 得到的梯度与所有进程的 batch 合在一起计算时相同
+                    normalization = all_reduce_sum(normalization) / self.world_size
+
+                # accum_count 个 batch 累积梯度后更新一次参数，step 为参数更新的次数
+                self.train_model.train()
+                self._gradient_accumulation(true_batchs, normalization, total_stats, report_stats)
 
                 report_stats = self._report_training(step, train_steps, self.optim.learning_rate, report_stats)
 
+                true_batchs = []
+                accum = 0
+                normalization = 0
+
                 if step % self.args.save_checkpoint_steps == 0:
-                    self._save(step)
+                    if is_master():
+                        self._save(step)
+                    # 其他进程等待 rank 0 保存完成，不在下一次 all_reduce 中等待
+                    barrier()
 
+                # 每个进程验证自己的一份验证集，统计量求和后由 rank 0 输出
                 if step % self.args.val_steps == 0:
                     valid_iter = self.get_test_iter()
                     if self.args.do_val and valid_iter:
@@ -86,31 +161,64 @@ class Trainer(object):
             for batch in valid_iter:
                 enc_input, dec_input, tgt_label, label_weight = \
                     batch.enc_input, batch.dec_input, batch.tgt_label, batch.label_weight
-                output = self.model(enc_input, dec_input)
+                with autocast(enc_input[0].device, self.args.bf16):
+                    output = self.model(enc_input, dec_input)
                 batch_stats = self.valid_loss.monolithic_compute_loss(tgt_label, output)
                 stats.update(batch_stats)
+
+            if self.world_size > 1:
+                stats = self._all_reduce_stats(stats)
             self._report_step(self.optim.learning_rate, step, valid_stats=stats)
             return stats
 
-    def _gradient_accumulation(self, batch, normalization, total_stats, report_stats):
-        enc_input, dec_input, tgt_label, label_weight = \
-            batch.enc_input, batch.dec_input, batch.tgt_label, batch.label_weight
-
-        self.model.zero_grad()
-
-        output = self.model(enc_input, dec_input)
-
-        batch_stats = self.train_loss.sharded_compute_loss(
-            tgt_label, output, self.shard_size, normalization
-        )
-
-        report_stats.n_src_words += enc_input[0].nelement()
-
-        total_stats.update(batch_stats)
-        report_stats.update(batch_stats)
-
+    def _gradient_accumulation(self, true_batchs, normalization, total_stats, report_stats):
+        """
+        :param true_batchs: 一次参数更新使用的 accum_count 个 batch
+        :param normalization: 这些 batch 中非 padding 的目标词总数，每个 batch 的 loss 都除以这个总数，
+            累积的梯度与把它们合成一个大 batch 时相同
+        """
+        self.train_model.zero_grad()
+
+        for i, batch in enumerate(true_batchs):
+            enc_input, dec_input, tgt_label, label_weight = \
+                batch.enc_input, batch.dec_input, batch.tgt_label, batch.label_weight
+
+            # 分布式训练时前 accum_count - 1 个 batch 的梯度只在本进程累积，最后一个 batch 反向传播时同步一次
+            if self.world_size > 1 and i < len(true_batchs) - 1:
+                sync_context = self.train_model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+
+            with sync_context:
+                if self.args.chunked_loss:
+                    loss, batch_stats = self.train_model(enc_input, dec_input, tgt_label)
+                    loss.div(normalization).backward()
+                else:
+                    # 只有前向在 autocast 下计算，模型输出的 log 概率为 fp32，loss 和反向传播在 autocast 之外
+                    with autocast(enc_input[0].device, self.args.bf16):
+                        output = self.train_model(enc_input, dec_input)
+                    batch_stats = self.train_loss.sharded_compute_loss(
+                        tgt_label, output, self.shard_size, normalization
+                    )
+
+            report_stats.n_src_words += enc_input[0].nelement()
+
+            total_stats.update(batch_stats)
+            report_stats.update(batch_stats)
+
+        report_stats.n_steps += 1
         self.optim.step()
 
+    def _all_reduce_stats(self, stats):
+        """
+        各进程的 loss / n_words / n_correct 求和
+        """
+        device = next(self.model.parameters()).device
+        values = torch.tensor([float(stats.loss), float(stats.n_words), float(stats.n_correct)],
+                              dtype=torch.float64, device=device)
+        loss, n_words, n_correct = all_reduce_sum(values).tolist()
+        return Statistics(loss, n_words, n_correct)
+
     def _save(self, step):
         checkpoint = {
             'step': step,
@@ -136,6 +244,7 @@ class Trainer(object):
             return self.report_manager.report_training(
                 step, num_steps, learning_rate, report_stats
             )
+        return report_stats
 
     def _report_step(self, lr, step, train_stats=None, valid_stats=None):
         if self.report_manager is not None:
@@ -1,10 +1,14 @@
 import json
 import glob
 import gc
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 
+from modules.memmap_dataset import MemmapDataset
 from utils.logger import logger
 
 
@@ -16,7 +20,7 @@ def chunks(l, n):
 class DataBatch(object):
 
     def __init__(self, n_heads, max_para_num, max_para_len, max_tgt_len, n_topic_words,
-                 data=None, pad_idx=None, device=None, is_test=False):
+                 data=None, pad_idx=None, device=None, is_test=False, pad_to_batch_max=False):
         self.n_heads = n_heads
         self.max_para_num = max_para_num
         self.max_para_len = max_para_len
@@ -29,6 +33,12 @@ class DataBatch(object):
             # src, tgt_ids, label_ids, tgt_str, graph
             self.batch_size = len(data)
 
+            if pad_to_batch_max:
+                # 只 pad 到当前 batch 内的最大段落数、段落长度和摘要长度
+                self.max_para_num, self.max_para_len, self.max_tgt_len = batch_shape(
+                    data, max_para_num, max_para_len, max_tgt_len
+                )
+
             enc_input, dec_input, tgt_label, label_weight = self.process_batch(data, device)
 
             setattr(self, 'enc_input', enc_input)
@@ -43,6 +53,29 @@ class DataBatch(object):
     def __len__(self):
         return self.batch_size
 
+    def _apply(self, fn):
+        # enc_input 与 dec_input 共享部分 mask，同一个 tensor 只处理一次
+        memo = {}
+
+        def _fn(tensor):
+            if id(tensor) not in memo:
+                memo[id(tensor)] = fn(tensor)
+            return memo[id(tensor)]
+
+        self.enc_input = tuple(_fn(t) for t in self.enc_input)
+        self.dec_input = tuple(_fn(t) for t in self.dec_input)
+        self.tgt_label = _fn(self.tgt_label)
+        self.label_weight = _fn(self.label_weight)
+
+    def pin_memory(self):
+        self._apply(lambda t: t.pin_memory())
+        return self
+
+    def to(self, device):
+        self._apply(lambda t: t.to(device, non_blocking=True))
+        self.device = device
+        return self
+
     def process_batch(self, data, device):
         src_words, src_words_pos, src_sents_pos, src_words_self_attn_bias, \
             src_sents_self_attn_bias, graph_attn_bias = self._pad_src_batch_data(
@@ -61,29 +94,24 @@ class DataBatch(object):
             device=device
         )
 
-        # [batch_size, max_para_num, n_heads, max_para_len, max_para_len]
-        src_words_self_attn_bias = src_words_self_attn_bias.unsqueeze(2).unsqueeze(3) \
-            .expand(-1, -1, self.n_heads, self.max_para_len, -1)
-        src_words_self_attn_bias.requires_grad = False
+        # 所有的 attention mask 均为 bool 类型，True 表示 padding，在 attention 内部广播到 n_heads 和 len_q
+        # [batch_size, max_para_num, 1, 1, max_para_len]
+        src_words_self_attn_bias = src_words_self_attn_bias.unsqueeze(2).unsqueeze(3)
 
-        src_sents_self_attn_bias = src_sents_self_attn_bias.unsqueeze(1).unsqueeze(2) \
-            .expand(-1, self.n_heads, self.max_para_num, -1)
-        src_sents_self_attn_bias.requires_grad = False
+        # [batch_size, 1, 1, max_para_num]
+        src_sents_self_attn_bias = src_sents_self_attn_bias.unsqueeze(1).unsqueeze(2)
 
-        graph_attn_bias = graph_attn_bias.unsqueeze(1).expand(-1, self.n_heads, -1, -1)
-        graph_attn_bias.requires_grad = False
+        # [batch_size, 1, max_para_num, max_para_num]
+        graph_attn_bias = graph_attn_bias.unsqueeze(1)
 
-        tgt_self_attn_bias = tgt_self_attn_bias.unsqueeze(1).expand(-1, self.n_heads, -1, -1)
-        tgt_self_attn_bias.requires_grad = False
+        # [batch_size, 1, max_tgt_len, max_tgt_len]
+        tgt_self_attn_bias = tgt_self_attn_bias.unsqueeze(1)
 
-        # [batch_size, max_para_num, n_heads, max_tgt_len, max_para_len]
-        tgt_src_words_attn_bias = src_words_self_attn_bias[:, :, :, 0].unsqueeze(3) \
-            .expand(-1, -1, -1, self.max_tgt_len, -1)
-        tgt_src_words_attn_bias.requires_grad = False
-
-        tgt_src_sents_attn_bias = src_sents_self_attn_bias[:, :, 0].unsqueeze(2) \
-            .expand(-1, -1, self.max_tgt_len, -1)
-        tgt_src_sents_attn_bias.requires_grad = False
+        # decoder 对 encoder 输出的 mask 与 encoder 的 key padding mask 相同
+        # [batch_size, max_para_num, 1, 1, max_para_len]
+        tgt_src_words_attn_bias = src_words_self_attn_bias
+        # [batch_size, 1, 1, max_para_num]
+        tgt_src_sents_attn_bias = src_sents_self_attn_bias
 
         src_words = src_words.view(-1, self.max_para_num, self.max_para_len)
         src_words_pos = src_words_pos.view(-1, self.max_para_num, self.max_para_len)
@@ -97,9 +125,10 @@ class DataBatch(object):
             tgt_topic_insts=[inst[5] for inst in data],
             para_topic_insts=[inst[6] for inst in data]
         )
-        tgt_topic_attn_bias = tgt_topic_attn_bias.unsqueeze(1).unsqueeze(2)\
-            .expand(-1, self.n_heads, self.max_tgt_len, -1)
-        para_topic_attn_bias = para_topic_attn_bias.unsqueeze(1).expand(-1, self.n_heads, -1, -1)
+        # [batch_size, 1, 1, n_topic_words]
+        tgt_topic_attn_bias = tgt_topic_attn_bias.unsqueeze(1).unsqueeze(2)
+        # [batch_size, 1, max_para_num, n_topic_words]
+        para_topic_attn_bias = para_topic_attn_bias.unsqueeze(1)
 
         enc_input = (src_words, src_words_pos, src_sents_pos, src_words_self_attn_bias,
                      src_sents_self_attn_bias, graph_attn_bias)
@@ -109,155 +138,181 @@ class DataBatch(object):
 
         return enc_input, dec_input, tgt_label, label_weight
 
-    def _pad(self, data, height, width, pad_id):
-        # input => [height, width]
-        rtn_data = [d + [pad_id] * (width - len(d)) for d in data]
-        rtn_data = rtn_data + [[pad_id] * width] * (height - len(data))
+    def _pad_src_batch_data(self, insts, graphs, device):
+        batch_size, max_para_num, max_para_len = len(insts), self.max_para_num, self.max_para_len
 
-        return rtn_data
+        # [batch_size, n_blocks]
+        para_nums = np.array([min(len(inst), max_para_num) for inst in insts], dtype=np.int64)
+        sents_mask = np.arange(max_para_num, dtype=np.int64) < para_nums[:, None]
+
+        # 先将所有段落 pad 到 [n_paras, n_tokens]，再按 sents_mask 放回 [batch_size, n_blocks, n_tokens]
+        paras = [para for inst in insts for para in inst[:max_para_num]]
+        para_words, para_mask = pad_sequences(paras, max_para_len, self.pad_idx)
 
-    def _pad_src_batch_data(self, insts, graphs, device):
         # [batch_size, n_blocks, n_tokens]
-        src_words = [self._pad(inst, self.max_para_num, self.max_para_len, self.pad_idx)
-                     for inst in insts]
-        src_words = torch.tensor(src_words, dtype=torch.int64, device=device)
+        src_words = np.full([batch_size, max_para_num, max_para_len], self.pad_idx, dtype=np.int64)
+        src_words[sents_mask] = para_words
+        words_mask = np.zeros([batch_size, max_para_num, max_para_len], dtype=np.bool_)
+        words_mask[sents_mask] = para_mask
 
         # [batch_size, n_blocks, n_tokens]
-        src_words_pos = [[list(range(0, len(para))) + [0] * (self.max_para_len - len(para))
-                          for para in inst] +
-                         [[0] * self.max_para_len] * (self.max_para_num - len(inst))
-                         for inst in insts]
-        src_words_pos = torch.tensor(src_words_pos, dtype=torch.int64, device=device)
+        src_words_pos = np.where(words_mask, np.arange(max_para_len, dtype=np.int64), 0)
 
         # [batch_size, n_blocks]
-        src_sents_pos = [list(range(0, len(inst))) + [0] * (self.max_para_num - len(inst))
-                         for inst in insts]
-        src_sents_pos = torch.tensor(src_sents_pos, dtype=torch.int64, device=device)
+        src_sents_pos = np.where(sents_mask, np.arange(max_para_num, dtype=np.int64), 0)
 
         # 在 paddings 上不计算 attention
         # [batch_size, n_blocks, n_tokens]
-        src_words_self_attn_bias = [[[0.0] * len(para) + [-1e18] * (self.max_para_len - len(para))
-                                     for para in inst] +
-                                    [[-1e18] * self.max_para_len] * (self.max_para_num - len(inst))
-                                    for inst in insts]
-        src_words_self_attn_bias = torch.tensor(src_words_self_attn_bias, dtype=torch.float32, device=device)
+        src_words_self_attn_bias = ~words_mask
 
         # [batch_size, n_blocks]
-        src_sents_self_attn_bias = [[0.0] * len(inst) + [-1e18] * (self.max_para_num - len(inst))
-                                    for inst in insts]
-        src_sents_self_attn_bias = torch.tensor(src_sents_self_attn_bias, dtype=torch.float32, device=device)
+        src_sents_self_attn_bias = ~sents_mask
 
-        graphs = [[[1.0 - float(sim) for sim in list(row)] for row in g] for g in graphs]
         # [batch_size, n_blocks, n_blocks]
-        graph_attn_bias = [self._pad(g, self.max_para_num, self.max_para_num, 1.0) for g in graphs]
-        graph_attn_bias = torch.tensor(graph_attn_bias, dtype=torch.float32, device=device)
+        graph_attn_bias = np.ones([batch_size, max_para_num, max_para_num], dtype=np.float32)
+        for i, graph in enumerate(graphs):
+            for j, sims in enumerate(graph[:max_para_num]):
+                sims = np.asarray(sims[:max_para_num], dtype=np.float64)
+                graph_attn_bias[i, j, :len(sims)] = 1.0 - sims
 
-        return [src_words, src_words_pos, src_sents_pos, src_words_self_attn_bias,
-                src_sents_self_attn_bias, graph_attn_bias]
+        return [to_tensor(src_words, device), to_tensor(src_words_pos, device), to_tensor(src_sents_pos, device),
+                to_tensor(src_words_self_attn_bias, device), to_tensor(src_sents_self_attn_bias, device),
+                to_tensor(graph_attn_bias, device)]
 
     def _pad_tgt_batch_data(self, insts, device):
+        max_tgt_len = self.max_tgt_len
+
         # [batch_size, max_tgt_len]
-        tgt_words = [inst + [self.pad_idx] * (self.max_tgt_len - len(inst))
-                     for inst in insts]
-        tgt_words = torch.tensor(tgt_words, dtype=torch.int64, device=device)
+        tgt_words, tgt_mask = pad_sequences(insts, max_tgt_len, self.pad_idx)
 
         # [batch_size, max_tgt_len]
-        tgt_pos = [list(range(0, len(inst))) + [0] * (self.max_tgt_len - len(inst))
-                   for inst in insts]
-        tgt_pos = torch.tensor(tgt_pos, dtype=torch.int64, device=device)
+        tgt_pos = np.where(tgt_mask, np.arange(max_tgt_len, dtype=np.int64), 0)
 
-        # tgt_self_attn_bias = [[[1.0] * self.max_tgt_len] * self.max_tgt_len] * len(insts)
-        tgt_self_attn_pad_bias = [[0.0] * len(inst) + [1.0] * (self.max_tgt_len - len(inst)) for inst in insts]
-        tgt_self_attn_pad_bias = torch.tensor(tgt_self_attn_pad_bias, dtype=torch.bool, device=device).unsqueeze(-2)
         # 上三角矩阵
+        # [max_tgt_len, max_tgt_len]
+        tgt_self_attn_subsequent_mask = np.triu(np.ones([max_tgt_len, max_tgt_len], dtype=np.bool_), k=1)
         # [batch_size, max_tgt_len, max_tgt_len]
-        tgt_self_attn_subsequent_bias = torch.triu(
-            torch.ones([len(insts), self.max_tgt_len, self.max_tgt_len], dtype=torch.float, device=device),
-            diagonal=1
-        ).to(torch.bool)
-        tgt_self_attn_bias = (tgt_self_attn_pad_bias | tgt_self_attn_subsequent_bias).to(torch.float) * -1e18
-        # * -1e18
+        tgt_self_attn_bias = ~tgt_mask[:, None, :] | tgt_self_attn_subsequent_mask
 
-        return [tgt_words, tgt_pos, tgt_self_attn_bias]
+        return [to_tensor(tgt_words, device), to_tensor(tgt_pos, device), to_tensor(tgt_self_attn_bias, device)]
 
     def _pad_label_batch_data(self, insts, device):
         # [batch_size, max_tgt_len]
-        tgt_label = [inst + [self.pad_idx] * (self.max_tgt_len - len(inst))
-                     for inst in insts]
-        tgt_label = torch.tensor(tgt_label, dtype=torch.int64, device=device)
+        tgt_label, label_mask = pad_sequences(insts, self.max_tgt_len, self.pad_idx)
 
         # [batch_size, max_tgt_len]
-        label_weight = [[1.0] * len(inst) + [0.0] * (self.max_tgt_len - len(inst))
-                        for inst in insts]
-        label_weight = torch.tensor(label_weight, dtype=torch.float32, device=device)
+        label_weight = label_mask.astype(np.float32)
 
-        return [tgt_label, label_weight]
+        return [to_tensor(tgt_label, device), to_tensor(label_weight, device)]
 
     def _pad_topic_batch_data(self, tgt_topic_insts, para_topic_insts):
-        tgt_topic = [inst + [self.pad_idx] * (self.n_topic_words - len(inst))
-                     for inst in tgt_topic_insts]
-        tgt_topic = torch.tensor(tgt_topic, dtype=torch.int64, device=self.device)
+        # [batch_size, n_topic_words]
+        tgt_topic, tgt_topic_mask = pad_sequences(tgt_topic_insts, self.n_topic_words, self.pad_idx)
+        tgt_topic_attn_bias = ~tgt_topic_mask
+
+        # [batch_size, max_para_num]
+        para_topic, para_topic_mask = pad_sequences(para_topic_insts, self.max_para_num, self.pad_idx)
+
+        # [batch_size, max_para_num, n_topic_words]
+        para_topic_attn_bias = ~(para_topic_mask[:, :, None] & tgt_topic_mask[:, None, :])
+
+        return to_tensor(tgt_topic, self.device), to_tensor(tgt_topic_attn_bias, self.device), \
+            to_tensor(para_topic, self.device), to_tensor(para_topic_attn_bias, self.device)
+
+
+def pad_sequences(insts, max_len, pad_idx):
+    """
+    将长度不一的 id 序列 pad 到 [n_insts, max_len]
+    :return: [n_insts, max_len] 的 id 矩阵, [n_insts, max_len] 的非 padding mask
+    """
+    lens = np.array([min(len(inst), max_len) for inst in insts], dtype=np.int64)
+    mask = np.arange(max_len, dtype=np.int64) < lens[:, None]
+
+    padded = np.full([len(insts), max_len], pad_idx, dtype=np.int64)
+    if insts:
+        padded[mask] = np.concatenate([np.asarray(inst[:max_len], dtype=np.int64) for inst in insts])
+
+    return padded, mask
+
+
+def to_tensor(array, device):
+    return torch.from_numpy(array).to(device)
+
+
+def example_shape(ex, max_para_num, max_para_len, max_tgt_len):
+    """
+    :param ex: (src, tgt_ids, ...)
+    :return: 截断后的 (段落数, 最长段落的长度, 摘要长度)
+    """
+    src, tgt_ids = ex[0][:max_para_num], ex[1]
+    para_len = max([len(para) for para in src], default=0)
+    return len(src), min(para_len, max_para_len), min(len(tgt_ids), max_tgt_len)
+
+
+def batch_shape(data, max_para_num, max_para_len, max_tgt_len):
+    """
+    :return: batch 内 (段落数, 段落长度, 摘要长度) 的最大值，每一维至少为 1
+    """
+    shapes = [example_shape(ex, max_para_num, max_para_len, max_tgt_len) for ex in data]
+    return tuple(max(1, max(dim)) for dim in zip(*shapes))
+
+
+def padded_size(shape):
+    """
+    pad 后单个样本的 token 数 (源端 + 目标端)
+    """
+    para_num, para_len, tgt_len = shape
+    return para_num * para_len + tgt_len
 
-        tgt_topic_attn_bias = [[0.0] * len(inst) + [-1e18] * (self.n_topic_words - len(inst))
-                               for inst in tgt_topic_insts]
-        tgt_topic_attn_bias = torch.tensor(tgt_topic_attn_bias, dtype=torch.float, device=self.device)
 
-        para_topic = [inst + [self.pad_idx] * (self.max_para_num - len(inst))
-                      for inst in para_topic_insts]
-        para_topic = torch.tensor(para_topic, dtype=torch.int64, device=self.device)
+def _glob_shards(data_path, phase, data_format):
+    suffix = '.bin' if data_format == 'memmap' else '.json'
+    pts = sorted(glob.glob(data_path + '/' + phase + '/*.[0-9]*' + suffix))
+    if not pts:
+        pts = sorted(glob.glob(data_path + '/' + phase + '/*' + suffix))
+    return pts
 
-        para_topic_attn_bias = [[[0.0] * len(tgt_topic_inst) + [-1e18] * (self.n_topic_words - len(tgt_topic_inst))]
-                                * len(para_topic_inst) +
-                                [[-1e18] * self.n_topic_words] * (self.max_para_num - len(para_topic_inst))
-                                for (para_topic_inst, tgt_topic_inst) in zip(para_topic_insts, tgt_topic_insts)]
-        para_topic_attn_bias = torch.tensor(para_topic_attn_bias, dtype=torch.float, device=self.device)
 
-        return tgt_topic, tgt_topic_attn_bias, para_topic, para_topic_attn_bias
+def _open_shard(pt_file, data_format):
+    if data_format == 'memmap':
+        return MemmapDataset(pt_file)
+    return json.load(open(pt_file))
 
 
 def load_dataset(args, phase, shuffle):
     assert phase in ['train', 'valid', 'test']
+    data_format = args.data_format
 
     def _lazy_dataset_loader(pt_file, phase):
-        dataset = json.load(open(pt_file))
+        dataset = _open_shard(pt_file, data_format)
         logger.info('Loading %s dataset from %s, number of examples: %d' %
                     (phase, pt_file, len(dataset)))
         return dataset
 
-    pts = sorted(glob.glob(args.data_path + '/' + phase + '/*.[0-9]*.json'))
-    if pts:
-        if shuffle:
-            np.random.shuffle(pts)
+    pts = _glob_shards(args.data_path, phase, data_format)
+    if shuffle:
+        np.random.shuffle(pts)
 
-        for pt in pts:
-            yield _lazy_dataset_loader(pt, phase)
-    else:
-        pt = sorted(glob.glob(args.data_path + '/' + phase + '/*.json'))
+    for pt in pts:
         yield _lazy_dataset_loader(pt, phase)
 
 
-def get_num_examples(data_path, phase):
+def get_num_examples(data_path, phase, data_format='json'):
     assert phase in ['train', 'valid', 'test']
 
-    def _lazy_dataset_loader(pt_file):
-        dataset = json.load(open(pt_file))
-        return len(dataset)
-
     num = 0
-    pts = sorted(glob.glob(data_path + '/' + phase + '/*.[0-9]*.json'))
-    if pts:
-        for pt in pts:
-            num += _lazy_dataset_loader(pt)
-    else:
-        pt = sorted(glob.glob(data_path + '/' + phase + '/*.json'))
-        num += _lazy_dataset_loader(pt)
+    for pt in _glob_shards(data_path, phase, data_format):
+        num += len(_open_shard(pt, data_format))
     return num
 
 
 class DataLoader(object):
 
     def __init__(self, args, datasets, symbols, batch_size, device,
-                 shuffle, is_test, random_seed=None):
+                 shuffle, is_test, random_seed=None, rank=0, world_size=1):
+        """
+        :param rank, world_size: 分布式训练时每个数据集分片中只读取下标 % world_size == rank 的样本
+        """
         self.args = args
         self.datasets = datasets
         self.symbols = symbols
@@ -265,6 +320,10 @@ class DataLoader(object):
         self.device = device
         self.shuffle = shuffle
         self.is_test = is_test
+        self.rank = rank
+        self.world_size = world_size
+        self.num_workers = args.num_workers
+        self.prefetch_batches = args.prefetch_batches
         self.cur_iter = self._next_dataset_iterator(datasets)
         assert self.cur_iter is not None
 
@@ -273,12 +332,74 @@ class DataLoader(object):
         np.random.seed(random_seed)
 
     def __iter__(self):
+        if self.num_workers > 0:
+            for batch in self._prefetch_iter():
+                yield batch
+            return
+
         dataset_iter = (d for d in self.datasets)
         while self.cur_iter is not None:
             for batch in self.cur_iter:
                 yield batch
             self.cur_iter = self._next_dataset_iterator(dataset_iter)
 
+    def _mini_batches(self):
+        dataset_iter = (d for d in self.datasets)
+        while self.cur_iter is not None:
+            data_iter = self.cur_iter
+            for mini_batch in data_iter.mini_batches():
+                yield data_iter, mini_batch
+            self.cur_iter = self._next_dataset_iterator(dataset_iter)
+
+    def _prefetch_iter(self):
+        """
+        后台线程按原有顺序切分 mini batch (所有随机数都在这个线程中按顺序消耗)，
+        num_workers 个线程并行构造 DataBatch，结果按提交顺序放入有界队列，
+        训练循环只需把 (pinned) 的 batch 拷贝到 device
+        """
+        pin_memory = torch.device(self.device).type == 'cuda'
+        futures = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+
+        def _make_batch(data_iter, mini_batch):
+            batch = data_iter.make_batch(mini_batch, device='cpu')
+            return batch.pin_memory() if pin_memory else batch
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    futures.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _produce(executor):
+            try:
+                for data_iter, mini_batch in self._mini_batches():
+                    if not _put(executor.submit(_make_batch, data_iter, mini_batch)):
+                        return
+            except Exception as e:
+                _put(e)
+                return
+            _put(None)
+
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        producer = threading.Thread(target=_produce, args=(executor,), daemon=True)
+        producer.start()
+        try:
+            while True:
+                future = futures.get()
+                if future is None:
+                    break
+                if isinstance(future, Exception):
+                    raise future
+                yield future.result().to(self.device)
+        finally:
+            stop.set()
+            producer.join()
+            executor.shutdown(wait=True)
+
     def _next_dataset_iterator(self, dataset_iter):
         try:
             if hasattr(self, 'cur_dataset'):
@@ -293,13 +414,14 @@ class DataLoader(object):
 
         return DataIterator(args=self.args, dataset=self.cur_dataset, symbols=self.symbols,
                             batch_size=self.batch_size, device=self.device,
-                            is_test=self.is_test, shuffle=self.shuffle)
+                            is_test=self.is_test, shuffle=self.shuffle,
+                            rank=self.rank, world_size=self.world_size)
 
 
 class DataIterator(object):
 
     def __init__(self, args, dataset, symbols, batch_size, graph_type='similarity',
-                 device=None, is_test=False, shuffle=True):
+                 device=None, is_test=False, shuffle=True, rank=0, world_size=1):
         self.args = args
         self.max_para_num = self.args.max_para_num
         self.max_para_len = self.args.max_para_len
@@ -315,6 +437,8 @@ class DataIterator(object):
         self.device = device
         self.is_test = is_test
         self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
 
         self.symbols = symbols
         self.eos_idx = self.symbols['EOS']
@@ -323,27 +447,36 @@ class DataIterator(object):
 
         self.iterations = 0
 
-        self.secondary_sort_key = lambda x: sum([len(xi) for xi in x[0]])
-        self.primary_sort_key = lambda x: len(x[1])
+        # 按 pad 后的形状 (段落数, 段落长度, 摘要长度) 分桶排序，形状相近的样本组成同一个 batch
+        self.sort_key = self.example_shape
         self._iterations_this_epoch = 0
 
     def data(self):
+        if self.world_size > 1:
+            # 按下标划分，与各进程的随机数状态无关，各进程的样本不重叠
+            indices = np.arange(self.rank, len(self.dataset), self.world_size)
+            if self.shuffle:
+                indices = np.random.permutation(indices)
+            return (self.dataset[i] for i in indices)
+
+        # 通过下标的排列打乱，memmap 数据集是只读的，不能原地 shuffle
         if self.shuffle:
-            np.random.shuffle(self.dataset)
-        xs = self.dataset
-        return xs
+            indices = np.random.permutation(len(self.dataset))
+            return (self.dataset[i] for i in indices)
+        return self.dataset
 
     def preprocess(self, ex):
         src, tgt, tgt_str, graph, tgt_topic, para_topic = \
             ex['src'], ex['tgt'], ex['tgt_str'], ex['sim_graph'], ex['tgt_topic'], ex['src_topic']
 
+        # src, graph 可以是 list 或 memmap 数组，切片后仍是视图
         src = src[:self.max_para_num]
         src = [para[:self.max_para_len] for para in src]
 
         graph = graph[:self.max_para_num]
         graph = [sim[:self.max_para_num] for sim in graph]
 
-        tgt = tgt[:-1][:self.max_tgt_len] + [self.eos_idx]
+        tgt = np.append(np.asarray(tgt[:-1][:self.max_tgt_len], dtype=np.int64), self.eos_idx)
         tgt_ids = tgt[:-1]
         label_ids = tgt[1:]
 
@@ -354,48 +487,34 @@ class DataIterator(object):
 
         return src, tgt_ids, label_ids, tgt_str, graph, tgt_topic, para_topic
 
-    def simple_batch_size_fn(self, new, count):
-        src, tgt = new[0], new[1]
-        global max_src_in_batch, max_tgt_in_batch
-        if count == 1:
-            max_src_in_batch = 0
-        max_src_in_batch = max(max_src_in_batch, len(src))
-        src_elements = count * max_src_in_batch
-        return src_elements
+    def example_shape(self, ex):
+        return example_shape(ex, self.max_para_num, self.max_para_len, self.max_tgt_len)
 
     def get_batch(self, data, batch_size):
-        batch, max_len = [], 0
+        """
+        in_tokens 时 batch_size 为 pad 到 batch 内最大形状后的 token 总数 (源端 + 目标端)
+        """
+        batch, shape = [], (0, 0, 0)
         for ex in data:
-            max_len = max(max_len, len(ex[1]))
+            ex_shape = self.example_shape(ex)
+            new_shape = tuple(max(dims) for dims in zip(shape, ex_shape))
             if self.args.in_tokens:
-                to_append = (len(batch) + 1) * max_len <= batch_size
+                to_append = (len(batch) + 1) * padded_size(new_shape) <= batch_size
             else:
                 to_append = len(batch) < batch_size
             if to_append:
                 batch.append(ex)
+                shape = new_shape
             else:
                 yield batch
-                batch, max_len = [ex], len([ex[1]])
+                batch, shape = [ex], ex_shape
         if batch:
             yield batch
 
     def batch_buffer(self, data, batch_size):
-        batch, max_len = [], 0
-        for ex in data:
-            ex = self.preprocess(ex)
-            max_len = max(max_len, len(ex[1]))
-            if self.args.in_tokens:
-                to_append = (len(batch) + 1) * max_len <= batch_size
-            else:
-                to_append = len(batch) < batch_size
-            if to_append:
-                batch.append(ex)
-            else:
-                yield batch
-                batch, max_len = [ex], len(ex[1])
-
-        if batch:
-            yield batch
+        preprocessed = (self.preprocess(ex) for ex in data)
+        for buffer in self.get_batch(preprocessed, batch_size):
+            yield buffer
 
     def create_batches(self):
         data = self.data()
@@ -407,7 +526,7 @@ class DataIterator(object):
                 )
             else:
                 p_batch = self.get_batch(
-                    sorted(sorted(buffer, key=self.secondary_sort_key), key=self.primary_sort_key),
+                    sorted(buffer, key=self.sort_key),
                     self.batch_size
                 )
             # list 可以迭代完 get_batch
@@ -420,7 +539,7 @@ class DataIterator(object):
                     continue
                 yield batch
 
-    def __iter__(self):
+    def mini_batches(self):
         while True:
             self.batches = self.create_batches()
             for idx, mini_batch in enumerate(self.batches):
@@ -428,9 +547,16 @@ class DataIterator(object):
                     continue
                 self.iterations += 1
                 self._iterations_this_epoch += 1
-                batch = DataBatch(self.args.n_heads, self.args.max_para_num, self.args.max_para_len,
-                                  self.args.max_tgt_len, self.args.num_topic_words,
-                                  mini_batch, self.symbols['PAD'], self.device, self.is_test)
 
-                yield batch
+                yield mini_batch
             return
+
+    def make_batch(self, mini_batch, device=None):
+        return DataBatch(self.args.n_heads, self.args.max_para_num, self.args.max_para_len,
+                         self.args.max_tgt_len, self.args.num_topic_words,
+                         mini_batch, self.symbols['PAD'], device or self.device, self.is_test,
+                         pad_to_batch_max=self.args.pad_to_batch_max)
+
+    def __iter__(self):
+        for mini_batch in self.mini_batches():
+            yield self.make_batch(mini_batch)
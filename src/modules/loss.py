@@ -1,6 +1,7 @@
+import math
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from utils.statistics import Statistics
 
@@ -22,24 +23,29 @@ class LabelSmoothingLoss(nn.Module):
         assert 0.0 < label_smoothing <= 1.0
         self.padding_idx = ignore_index
 
-        smoothing_value = label_smoothing / (tgt_vocab_size - 2)
-        one_hot = torch.full((tgt_vocab_size,), smoothing_value)
-        one_hot[self.padding_idx] = 0
-        self.register_buffer('one_hot', one_hot.unsqueeze(0))
-
+        # q 中真实单词为 confidence，padding 为 0，其余 tgt_vocab_size - 2 个单词为 smoothing_value
+        self.smoothing_value = label_smoothing / (tgt_vocab_size - 2)
         self.confidence = 1.0 - label_smoothing
 
+        # 每个非 padding 位置的 sum(q * log(q))，是常数
+        self.q_entropy = self.confidence * math.log(self.confidence) if self.confidence > 0 else 0.0
+        self.q_entropy += (tgt_vocab_size - 2) * self.smoothing_value * math.log(self.smoothing_value)
+
     def forward(self, output, target):
         """
-        :param output: [batch_size * max_tgt_len, vocab_size]
+        KL(q || p) = sum(q * log(q)) - sum(q * log(p))，q 只有三种取值，
+        所以只需要真实单词的 log 概率、每行 log 概率之和以及 padding 列，不需要构造 [N, vocab_size] 的 q
+        :param output: log 概率 [batch_size * max_tgt_len, vocab_size]
         :param target: [batch_size * max_tgt_len]
         """
-        # [batch_size * max_tgt_len, vocab_size]
-        model_prob = self.one_hot.repeat(target.size(0), 1)
-        model_prob.scatter_(1, target.unsqueeze(1), self.confidence)
-        model_prob.masked_fill_((target == self.padding_idx).unsqueeze(1), 0)
+        # [batch_size * max_tgt_len]
+        gold_log_prob = output.gather(1, target.unsqueeze(1)).squeeze(1)
+        other_log_prob = output.sum(dim=1) - gold_log_prob - output[:, self.padding_idx]
 
-        return F.kl_div(output, model_prob, reduction='sum')
+        loss = self.q_entropy - self.confidence * gold_log_prob - self.smoothing_value * other_log_prob
+        loss = loss.masked_fill(target == self.padding_idx, 0)
+
+        return loss.sum()
 
 
 class NMTLossCompute(nn.Module):
@@ -53,11 +59,14 @@ class NMTLossCompute(nn.Module):
             self.criterion = nn.NLLLoss(ignore_index=self.padding_idx, reduction='sum')
 
     def _stats(self, loss, scores, target):
+        """
+        统计量保留为 device 上的张量，不调用 .item()，只在 report 时才同步到 host
+        """
         pred = scores.argmax(dim=1)
         non_padding = target.ne(self.padding_idx)
-        num_correct = pred.eq(target).masked_select(non_padding).sum().item()
-        num_non_padding = non_padding.sum().item()
-        return Statistics(loss.item(), num_non_padding, num_correct)
+        num_correct = (pred.eq(target) & non_padding).sum()
+        num_non_padding = non_padding.sum()
+        return Statistics(loss, num_non_padding, num_correct)
 
     def _compute_loss(self, output, target):
         output = output.view(-1, output.size(1))
@@ -65,7 +74,7 @@ class NMTLossCompute(nn.Module):
 
         loss = self.criterion(output, ground_truth)
 
-        stats = self._stats(loss.clone(), output, ground_truth)
+        stats = self._stats(loss.detach(), output.detach(), ground_truth)
 
         return loss, stats
 
@@ -77,18 +86,54 @@ class NMTLossCompute(nn.Module):
         """
         :param target: [batch_size * max_tgt_len]
         :param output: [batch_size * max_tgt_len, vocab_size]
-        :param shard_size:
-        :param normalization:
+        :param shard_size: 每次计算 loss 的行数，为 0 时不分片，直接对整个 output 计算并反向传播
+        :param normalization: 非 padding 的目标词数，可以是 device 上的张量
         """
+        if not shard_size:
+            loss, batch_stats = self._compute_loss(output, target)
+            loss.div(normalization).backward()
+            return batch_stats
+
         batch_stats = Statistics()
         shard_state = {"output": output, "target": target}
         for shard in shards(shard_state, shard_size):
             loss, stats = self._compute_loss(**shard)
-            loss.div(float(normalization)).backward()
+            loss.div(normalization).backward()
             batch_stats.update(stats)
 
         return batch_stats
 
+    def chunked_compute_loss(self, target, dec_output, generator, chunk_size):
+        """
+        每次只对 chunk_size 行计算 generator 和 loss，并对每一块做 checkpoint，
+        完整的 [batch_size * max_tgt_len, vocab_size] log 概率不会同时存在，反向传播时重新计算每一块的 logits。
+        返回所有块的 loss 之和，由调用者除以 normalization 后只做一次反向传播
+        :param target: [batch_size * max_tgt_len]
+        :param dec_output: decoder 的输出 [batch_size * max_tgt_len, d_model]
+        :param generator: dec_output => log 概率 [n, vocab_size]
+        :param chunk_size: 每块的行数，为 0 时整体作为一块
+        :return: loss, 统计量
+        """
+        def _chunk_loss(dec_output_chunk, target_chunk):
+            output = generator(dec_output_chunk)
+            loss = self.criterion(output, target_chunk)
+            # 统计量不需要梯度，与 loss 一起返回，避免在 checkpoint 外再计算一次 generator
+            non_padding = target_chunk.ne(self.padding_idx)
+            num_correct = (output.detach().argmax(dim=1).eq(target_chunk) & non_padding).sum()
+            return loss, num_correct
+
+        target = target.contiguous().view(-1)
+        chunk_size = chunk_size or target.size(0)
+        total_loss, total_correct = 0, 0
+        for dec_output_chunk, target_chunk in zip(torch.split(dec_output, chunk_size),
+                                                  torch.split(target, chunk_size)):
+            loss, num_correct = checkpoint(_chunk_loss, dec_output_chunk, target_chunk, use_reentrant=False)
+            total_loss = total_loss + loss
+            total_correct = total_correct + num_correct
+
+        num_non_padding = target.ne(self.padding_idx).sum()
+        return total_loss, Statistics(total_loss.detach(), num_non_padding, total_correct)
+
 
 def filter_shard_state(state, shard_size=None):
     for k, v in state.items():
@@ -0,0 +1,172 @@
+import os
+import json
+import glob
+
+import numpy as np
+
+from utils.logger import logger
+
+
+# 每个 json 分片转换为一个 <name>.bin 目录，目录下每个字段保存为一个 .npy 文件，
+# 变长字段拆分为扁平的数值数组和 [n + 1] 的 offsets 索引
+TGT_TOPIC_DTYPE = np.dtype([('id', np.int32), ('score', np.float32)])
+
+
+def _concat(arrays, dtype):
+    if arrays:
+        return np.concatenate(arrays).astype(dtype, copy=False)
+    return np.zeros([0], dtype=dtype)
+
+
+def _offsets(lengths):
+    offsets = np.zeros([len(lengths) + 1], dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def convert_json_shard(json_file, bin_dir):
+    """
+    将一个 json 分片转换为按列存储的二进制格式
+    :param json_file: *.N.json 分片
+    :param bin_dir: 输出目录 *.N.bin
+    :return: 样本数
+    """
+    dataset = json.load(open(json_file))
+
+    paras, para_lens, n_paras = [], [], []
+    tgts, tgt_strs = [], []
+    graphs, graph_rows = [], []
+    tgt_topics, src_topics = [], []
+    for ex in dataset:
+        n_paras.append(len(ex['src']))
+        for para in ex['src']:
+            paras.append(np.asarray(para, dtype=np.int32))
+            para_lens.append(len(para))
+
+        tgts.append(np.asarray(ex['tgt'], dtype=np.int32))
+        tgt_strs.append(np.frombuffer(ex['tgt_str'].encode('utf-8'), dtype=np.uint8))
+
+        # 相似度矩阵 [n_rows, n_rows]
+        graph = np.asarray(ex['sim_graph'], dtype=np.float16).reshape(len(ex['sim_graph']), -1)
+        assert graph.shape[0] == graph.shape[1]
+        graphs.append(graph.reshape(-1))
+        graph_rows.append(graph.shape[0])
+
+        tgt_topics.append(np.array([tuple(topic) for topic in ex['tgt_topic']], dtype=TGT_TOPIC_DTYPE))
+        src_topics.append(np.asarray(ex['src_topic'], dtype=np.int32))
+
+    graph_rows = np.asarray(graph_rows, dtype=np.int64)
+    columns = {
+        'src_tokens': _concat(paras, np.int32),
+        'src_para_offsets': _offsets(para_lens),
+        'src_offsets': _offsets(n_paras),
+        'tgt_tokens': _concat(tgts, np.int32),
+        'tgt_offsets': _offsets([len(tgt) for tgt in tgts]),
+        'tgt_str_bytes': _concat(tgt_strs, np.uint8),
+        'tgt_str_offsets': _offsets([len(tgt_str) for tgt_str in tgt_strs]),
+        'sim_graph': _concat(graphs, np.float16),
+        'sim_graph_offsets': _offsets(graph_rows * graph_rows),
+        'sim_graph_rows': graph_rows,
+        'tgt_topic': _concat(tgt_topics, TGT_TOPIC_DTYPE),
+        'tgt_topic_offsets': _offsets([len(topic) for topic in tgt_topics]),
+        'src_topic': _concat(src_topics, np.int32),
+        'src_topic_offsets': _offsets([len(topic) for topic in src_topics])
+    }
+
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(bin_dir, name + '.npy'), column)
+
+    return len(dataset)
+
+
+def convert_dataset(data_path, phases=('train', 'valid', 'test')):
+    """
+    将 data_path 下各阶段的所有 json 分片转换为同名的 .bin 目录
+    """
+    for phase in phases:
+        for json_file in sorted(glob.glob(os.path.join(data_path, phase, '*.json'))):
+            bin_dir = json_file[:-len('.json')] + '.bin'
+            num = convert_json_shard(json_file, bin_dir)
+            logger.info('Converted %s to %s, number of examples: %d' % (json_file, bin_dir, num))
+
+
+def example_to_json(ex):
+    """
+    将 MemmapDataset 的样本转换为与 json 分片相同的 python 对象
+    """
+    return {
+        'src': [para.tolist() for para in ex['src']],
+        'tgt': ex['tgt'].tolist(),
+        'tgt_str': ex['tgt_str'],
+        'sim_graph': ex['sim_graph'].astype(np.float64).tolist(),
+        'tgt_topic': [list(topic) for topic in ex['tgt_topic'].tolist()],
+        'src_topic': ex['src_topic'].tolist()
+    }
+
+
+class MemmapDataset(object):
+    """
+    以 numpy.memmap 打开 convert_json_shard 生成的目录，按需切片出单个样本，
+    样本中的数组都是 memmap 上的视图，不会拷贝数据
+    """
+
+    def __init__(self, bin_dir):
+        self.bin_dir = bin_dir
+
+        def _load(name):
+            return np.load(os.path.join(bin_dir, name + '.npy'), mmap_mode='r')
+
+        self.src_tokens = _load('src_tokens')
+        self.tgt_tokens = _load('tgt_tokens')
+        self.tgt_str_bytes = _load('tgt_str_bytes')
+        self.sim_graph = _load('sim_graph')
+        self.tgt_topic = _load('tgt_topic')
+        self.src_topic = _load('src_topic')
+
+        # offsets 很小，直接读入内存
+        self.src_para_offsets = np.array(_load('src_para_offsets'))
+        self.src_offsets = np.array(_load('src_offsets'))
+        self.tgt_offsets = np.array(_load('tgt_offsets'))
+        self.tgt_str_offsets = np.array(_load('tgt_str_offsets'))
+        self.sim_graph_offsets = np.array(_load('sim_graph_offsets'))
+        self.sim_graph_rows = np.array(_load('sim_graph_rows'))
+        self.tgt_topic_offsets = np.array(_load('tgt_topic_offsets'))
+        self.src_topic_offsets = np.array(_load('src_topic_offsets'))
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError('MemmapDataset index out of range')
+        index = int(index) % len(self)
+
+        para_begin, para_end = self.src_offsets[index: index + 2]
+        para_offsets = self.src_para_offsets[para_begin: para_end + 1].tolist()
+        src = [self.src_tokens[begin: end] for begin, end in zip(para_offsets[:-1], para_offsets[1:])]
+
+        n_rows = self.sim_graph_rows[index]
+        graph_begin, graph_end = self.sim_graph_offsets[index: index + 2]
+        graph = self.sim_graph[graph_begin: graph_end].reshape(n_rows, n_rows)
+
+        tgt_str_begin, tgt_str_end = self.tgt_str_offsets[index: index + 2]
+        tgt_str = self.tgt_str_bytes[tgt_str_begin: tgt_str_end].tobytes().decode('utf-8')
+
+        return {
+            'src': src,
+            'tgt': self._slice(self.tgt_tokens, self.tgt_offsets, index),
+            'tgt_str': tgt_str,
+            'sim_graph': graph,
+            'tgt_topic': self._slice(self.tgt_topic, self.tgt_topic_offsets, index),
+            'src_topic': self._slice(self.src_topic, self.src_topic_offsets, index)
+        }
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @staticmethod
+    def _slice(column, offsets, index):
+        begin, end = offsets[index: index + 2]
+        return column[begin: end]
@@ -32,9 +32,12 @@ def build_optim(args, model: nn.Module, checkpoint):
                 no_decay.add(m.bias)
 
     assert len(list(model.parameters())) == len(decay) + len(no_decay)
+    # 按 model.parameters() 的顺序排列，set 的迭代顺序与对象地址有关，
+    # 每次运行以及每个进程都可能不同，会导致加载的 optimizer state 与参数对不上
+    decay_ids = set(id(p) for p in decay)
     groups = [
-        {'params': list(decay), 'weight_decay': optimizer.weight_decay},
-        {'params': list(no_decay), 'weight_decay': 0.0}
+        {'params': [p for p in model.parameters() if id(p) in decay_ids], 'weight_decay': optimizer.weight_decay},
+        {'params': [p for p in model.parameters() if id(p) not in decay_ids], 'weight_decay': 0.0}
     ]
     optimizer.set_parameters(groups)
 
@@ -1,10 +1,13 @@
 import torch
+import logging
 import argparse
 import random
 import sentencepiece
 import os
+import time
 
-from modules.data_loader import DataLoader, load_dataset
+from modules.data_loader import DataLoader, load_dataset, get_num_examples
+from modules.memmap_dataset import convert_dataset
 from models.model_builder import MultiDocSum
 from model_topic_kvs.model_builder import MDSTopicKVS
 from model_mtsp.model_builder import MDSTopicSP
@@ -14,6 +17,8 @@ from models.trainer_builder import build_trainer
 from models.predictor_builder import build_predictor
 
 from utils.logger import init_logger, logger
+from utils.quantize import quantize_model, quantized_checkpoint_path, save_quantized, is_quantized
+from utils.distributed import init_distributed, is_master, get_rank, get_world_size, cleanup_distributed
 
 
 def str2bool(v):
@@ -27,11 +32,26 @@ def str2bool(v):
 
 def main():
     device = 'cuda' if args.use_cuda else 'cpu'
-    init_logger(args.log_file)
+    if args.mode == 'train':
+        # torchrun 启动多个进程时做数据并行，每个进程使用一块 GPU (use_cuda) 或若干 CPU 核
+        local_rank = init_distributed(args.dist_backend, args.dist_timeout)
+        if args.use_cuda and get_world_size() > 1:
+            device = 'cuda:%d' % local_rank
+            torch.cuda.set_device(local_rank)
+    # 只有 rank 0 写日志文件并输出 INFO 日志，其他进程只输出 WARNING 及以上
+    if is_master():
+        init_logger(args.log_file)
+    else:
+        init_logger(None, level=logging.WARNING)
     if args.mode == 'train':
         train(device)
+        cleanup_distributed()
     elif args.mode == 'test':
         test(device)
+    elif args.mode == 'convert':
+        convert_dataset(args.data_path)
+    elif args.mode == 'compare_quantize':
+        compare_quantize()
 
 
 def get_model(args, symbols, spm, device, checkpoint):
@@ -49,6 +69,29 @@ def get_model(args, symbols, spm, device, checkpoint):
     return model
 
 
+def get_inference_model(args, symbols, spm, device, checkpoint):
+    """
+    构建推理用的模型：checkpoint 是量化模型，或者设置了 --quantize int8 时，返回动态量化后的模型
+    """
+    if is_quantized(checkpoint):
+        # 先构建同样结构的量化模型，再加载量化后的参数
+        args.attn_backend = checkpoint['opt'].attn_backend
+        model = quantize_model(get_model(args, symbols, spm, device, None))
+        model.load_state_dict(checkpoint['model'])
+    else:
+        model = get_model(args, symbols, spm, device, checkpoint)
+        if args.quantize == 'int8':
+            model = quantize_model(model)
+
+    if args.bf16 and (args.quantize == 'int8' or is_quantized(checkpoint)):
+        # 动态量化的 Linear 只接受 fp32 输入
+        logger.info('bf16 autocast is disabled for the int8 model')
+        args.bf16 = False
+
+    model.eval()
+    return model
+
+
 def get_spm(vocab_path):
     spm = sentencepiece.SentencePieceProcessor()
     spm.Load(vocab_path)
@@ -63,6 +106,10 @@ def get_spm(vocab_path):
 
 
 def train(device):
+    # top-k 段落的词级 attention 只用于推理，训练和验证时都计算全部段落
+    if args.word_attn_top_k:
+        logger.warning('--word_attn_top_k is only used at inference, ignored in training')
+        args.word_attn_top_k = 0
     logger.info(args)
     torch.manual_seed(args.random_seed)
     torch.cuda.manual_seed(args.random_seed)
@@ -78,12 +125,16 @@ def train(device):
     vocab_size = len(spm)
 
     def train_iter_fct():
+        # 分布式训练时每个进程只读取属于自己的样本
         return DataLoader(args, load_dataset(args, 'train', shuffle=True), symbols,
-                          args.batch_size, device, shuffle=True, is_test=False)
+                          args.batch_size, device, shuffle=True, is_test=False,
+                          rank=get_rank(), world_size=get_world_size())
 
     def get_test_iter():
+        # 验证集同样按进程切分，各进程的统计量在 Trainer.validate 中求和
         return DataLoader(args, load_dataset(args, 'test', shuffle=False), symbols,
-                          args.batch_size, device, shuffle=False, is_test=True)
+                          args.batch_size, device, shuffle=False, is_test=True,
+                          rank=get_rank(), world_size=get_world_size())
 
     model = get_model(args, symbols, spm, device, checkpoint)
 
@@ -92,9 +143,10 @@ def train(device):
 
     optim = build_optim(args, model, checkpoint)
 
-    with open(os.path.join(args.model_path, 'model.stru'), 'w') as file:
-        file.write(str(model))
-        logger.info('Write model structure to %s' % file.name)
+    if is_master():
+        with open(os.path.join(args.model_path, 'model.stru'), 'w') as file:
+            file.write(str(model))
+            logger.info('Write model structure to %s' % file.name)
 
     trainer = build_trainer(args, device, model, symbols, vocab_size, optim, get_test_iter)
     trainer.train(train_iter_fct, args.train_steps)
@@ -110,8 +162,14 @@ def test(device):
 
     spm, symbols = get_spm(args.vocab_path)
 
-    model = get_model(args, symbols, spm, device, checkpoint)
-    model.eval()
+    if args.quantize == 'int8' or is_quantized(checkpoint):
+        # 动态量化只支持 CPU
+        device = 'cpu'
+    model = get_inference_model(args, symbols, spm, device, checkpoint)
+    if args.quantize == 'int8' and not is_quantized(checkpoint):
+        quantized_path = quantized_checkpoint_path(args.checkpoint)
+        save_quantized(model, args, quantized_path)
+        logger.info('Save quantized model to %s' % quantized_path)
 
     test_iter = DataLoader(args, load_dataset(args, 'test', shuffle=False), symbols,
                            args.batch_size, device, shuffle=False, is_test=True)
@@ -119,18 +177,72 @@ def test(device):
     predictor.translate(test_iter, step)
 
 
+def compare_quantize():
+    """
+    在测试集上比较 float 模型和 int8 动态量化模型的 ROUGE 和 CPU 解码延迟，
+    两个模型的结果分别写到 result_path 下的 float 和 int8 目录
+    """
+    logger.info(args)
+    assert args.checkpoint != ''
+
+    step = int(args.checkpoint.split('.')[-2].split('_')[-1])
+    logger.info('Loading checkpoint from %s' % args.checkpoint)
+    checkpoint = torch.load(args.checkpoint, map_location=lambda storage, loc: storage)
+    assert not is_quantized(checkpoint), 'Expected a float checkpoint'
+
+    spm, symbols = get_spm(args.vocab_path)
+    n_examples = get_num_examples(args.data_path, 'test', args.data_format)
+
+    result_path = args.result_path
+    reports = []
+    for quantize in ('none', 'int8'):
+        args.quantize = quantize
+        args.result_path = os.path.join(result_path, 'float' if quantize == 'none' else quantize)
+        os.makedirs(args.result_path, exist_ok=True)
+
+        model = get_inference_model(args, symbols, spm, 'cpu', checkpoint)
+        test_iter = DataLoader(args, load_dataset(args, 'test', shuffle=False), symbols,
+                               args.batch_size, 'cpu', shuffle=False, is_test=True)
+        predictor = build_predictor(args, spm, symbols, model, 'cpu')
+
+        start = time.time()
+        rouges = predictor.translate(test_iter, step)
+        latency = (time.time() - start) * 1000 / n_examples
+        reports.append((quantize, latency, rouges))
+
+    args.result_path = result_path
+    for quantize, latency, rouges in reports:
+        if rouges is not None:
+            logger.info('quantize=%s: %.1f ms/example, ROUGE-1/2/L F %.2f/%.2f/%.2f'
+                        % (quantize, latency, rouges['rouge_1_f_score'] * 100,
+                           rouges['rouge_2_f_score'] * 100, rouges['rouge_l_f_score'] * 100))
+        else:
+            logger.info('quantize=%s: %.1f ms/example' % (quantize, latency))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--mode', default='train', type=str, choices=['train', 'test'], help='Run mode')
+    parser.add_argument('--mode', default='train', type=str,
+                        choices=['train', 'test', 'convert', 'compare_quantize'],
+                        help='Run mode, convert: convert json shards in data_path to the memmap format, '
+                             'compare_quantize: compare ROUGE and latency of the float and int8 models')
     parser.add_argument('--log_file', default='../log/graph_sum.log', type=str, help='Path to .log')
     parser.add_argument('--do_val', default=True, type=str2bool, help='Whether to do validation while training')
     parser.add_argument('--use_cuda', action='store_true')
+    parser.add_argument('--dist_backend', default='gloo', type=str, choices=['gloo', 'nccl'],
+                        help='Backend of torch.distributed when training is launched with torchrun '
+                             '(e.g. torchrun --nproc_per_node 4 run.py --mode train), gloo works on CPU and GPU')
+    parser.add_argument('--dist_timeout', default=30, type=int,
+                        help='Timeout in minutes of torch.distributed collectives, processes wait for each other '
+                             'at most this long, e.g. while rank 0 saves a checkpoint')
     parser.add_argument('--data_path', default='../../data/MultiNews', type=str, help='Path to data')
     parser.add_argument('--model_path', default='../models', type=str, help='Path to save model')
     parser.add_argument('--checkpoint', default='', type=str, help='Path to checkpoint')
     parser.add_argument('--vocab_path', default='../vocab/spm9998_3.model', type=str,
                         help='Path to sentencepiece model')
     parser.add_argument('--random_seed', default=1, type=int, help='Random seed')
+    parser.add_argument('--data_format', default='json', type=str, choices=['json', 'memmap'],
+                        help='Format of the dataset shards, memmap shards are produced by --mode convert')
 
     # dataset-related arguments
     parser.add_argument('--batch_size', default=4, type=int, help='Number of examples in one batch')
@@ -143,8 +255,15 @@ if __name__ == '__main__':
     parser.add_argument('--max_out_len', default=300, type=int, help='max length of decoding')
     parser.add_argument('--min_out_len', default=200, type=int, help='min length of decoding')
     parser.add_argument('--in_tokens', default=False, type=str2bool,
-                        help='If True, batch size will be the maximum number of tokens in one batch.'
-                             'else, batch size will be the maximum number of examples in one batch')
+                        help='If True, batch size will be the maximum number of padded source and target tokens '
+                             'in one batch, else, batch size will be the maximum number of examples in one batch')
+    parser.add_argument('--pad_to_batch_max', default=True, type=str2bool,
+                        help='Pad each batch to its own max paragraph number, paragraph length and target length '
+                             'instead of max_para_num, max_para_len and max_tgt_len')
+    parser.add_argument('--num_workers', default=0, type=int,
+                        help='Number of threads building batches in background, 0 builds batches in the main loop')
+    parser.add_argument('--prefetch_batches', default=8, type=int,
+                        help='Max number of batches prepared ahead when num_workers > 0')
     parser.add_argument('--max_pos_embed', default=512, type=int, help='Max position embeddings')
     parser.add_argument('--num_topic_words', default=10, type=int)
     parser.add_argument('--min_topic_words', default=3, type=int)
@@ -173,6 +292,18 @@ if __name__ == '__main__':
     parser.add_argument('--dec_graph_layers', default=8, type=int, help='Number of decoder graph layers')
     parser.add_argument('--n_heads', default=8, type=int, help='Number of attention heads')
     parser.add_argument('--dropout_prob', default=0.1, type=float, help='Dropout probability')
+    parser.add_argument('--attn_backend', default='default', type=str, choices=['default', 'sdpa'],
+                        help='Self-attention implementation, sdpa fuses the Q/K/V projections and uses '
+                             'F.scaled_dot_product_attention. Checkpoints load with either backend')
+    parser.add_argument('--bf16', default=False, type=str2bool,
+                        help='Run training and decoding under bf16 autocast, '
+                             'log_softmax of the generator and the loss stay in fp32')
+    parser.add_argument('--word_attn_chunk_size', default=0, type=int,
+                        help='Number of paragraphs per chunk in decoder word attention, '
+                             'chunks are recomputed in backward to bound memory. 0 to disable')
+    parser.add_argument('--word_attn_top_k', default=0, type=int,
+                        help='At inference, only attend to the words of the top k paragraphs '
+                             'per decoder query in word attention. 0 to disable')
 
     # optimizer-related arguments
     parser.add_argument('--optimizer', default='adamw', type=str, choices=['adam', 'adamw'],
@@ -189,8 +320,14 @@ if __name__ == '__main__':
                         help='The training steps to perform linear learning rate warmup')
     parser.add_argument('--eps', default=1e-9, type=float, help='eps for adam optimizer')
     parser.add_argument('--max_generator_batches', default=32, type=int,
-                        help='shard size in compute loss when training')
+                        help='shard size in compute loss when training, 0 to compute the loss without sharding')
+    parser.add_argument('--chunked_loss', default=False, type=str2bool,
+                        help='Compute the generator and the loss in chunks of max_generator_batches rows '
+                             'inside the loss with checkpointing, instead of sharding the full log-probs')
     parser.add_argument('--label_smoothing', default=0.1, type=float, help='Label smoothing in loss compute')
+    parser.add_argument('--accum_count', default=1, type=int,
+                        help='Number of batches whose gradients are accumulated before each optimizer step, '
+                             'the effective batch size is batch_size * accum_count')
     parser.add_argument('--max_grad_norm', default=2.0, type=float, help='The max gradient norm')
 
     # for decode
@@ -200,6 +337,9 @@ if __name__ == '__main__':
     parser.add_argument('--report_rouge', default=True, type=str2bool,
                         help='Whether to report rouge when decode finish')
     parser.add_argument('--block_trigram', default=True, type=str2bool, help='Remove repeated trigrams in summary')
+    parser.add_argument('--quantize', default='none', type=str, choices=['none', 'int8'],
+                        help='Dynamic int8 quantization of the nn.Linear layers for CPU inference, '
+                             'the quantized model is saved next to the checkpoint with an int8_ prefix')
 
     args = parser.parse_args()
 
@@ -0,0 +1,149 @@
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+from models.neural_modules.attention_modules import GraphScaledDotProductAttentionWithMask
+
+
+def make_module(n_heads, dim_per_head, max_para_num=None):
+    module = GraphScaledDotProductAttentionWithMask(
+        0.0, n_heads * dim_per_head, dim_per_head, dim_per_head, 1.0, 'cpu', max_para_num=max_para_num
+    )
+    return module.eval()
+
+
+def reference_select_graph_attn_mask(graph_attn_bias, pos):
+    """
+    原先的实现：将 graph_attn_bias 展开到 [batch_size, n_heads, len_q, len_k_s, len_k_s]，
+    用 torch.cat 拼出下标后做 advanced indexing
+    :param graph_attn_bias: [batch_size, n_heads, len_k_s, len_k_s]
+    :param pos: [batch_size, n_heads, len_q, 1]
+    """
+    batch_size, n_heads, len_q = pos.size(0), pos.size(1), pos.size(2)
+
+    pos_up = torch.ceil(pos).to(torch.int64)
+    pos_down = torch.floor(pos).to(torch.int64)
+
+    batch_ind = torch.arange(0, batch_size, 1, dtype=torch.int64)
+    batch_ind = batch_ind.view(batch_size, 1, 1, 1).expand(-1, n_heads, len_q, -1)
+    head_ind = torch.arange(0, n_heads, 1, dtype=torch.int64)
+    head_ind = head_ind.view(1, n_heads, 1, 1).expand(batch_size, -1, len_q, -1)
+    query_ind = torch.arange(start=0, end=len_q, step=1, dtype=torch.int64)
+    query_ind = query_ind.view(1, 1, len_q, 1).expand(batch_size, n_heads, -1, -1)
+
+    # [4, batch_size, n_heads, len_q]
+    pos_up_ind = torch.cat((batch_ind, head_ind, query_ind, pos_up), dim=3).permute(3, 0, 1, 2)
+    pos_down_ind = torch.cat((batch_ind, head_ind, query_ind, pos_down), dim=3).permute(3, 0, 1, 2)
+
+    # [batch_size, n_heads, len_q, len_k_s, len_k_s]
+    graph_attn_mask = graph_attn_bias.unsqueeze(2).expand(-1, -1, len_q, -1, -1)
+
+    graph_attn_mask_up = graph_attn_mask[tuple(pos_up_ind)]
+    graph_attn_mask_down = graph_attn_mask[tuple(pos_down_ind)]
+
+    return graph_attn_mask_up * (1.0 - (pos_up.to(torch.float32) - pos)) + \
+        graph_attn_mask_down * (1.0 - (pos - pos_down.to(torch.float32)))
+
+
+def reference_forward(module, q, k, v, bias, graph_attn_bias):
+    """用 reference_select_graph_attn_mask 复现 GraphScaledDotProductAttentionWithMask.forward"""
+    batch_size, n_heads, len_q, len_k_s = q.size(0), q.size(1), q.size(2), k.size(2)
+    scaled_q = q / (module.d_k ** 0.5)
+    attn = torch.matmul(scaled_q, k.transpose(2, 3))
+
+    pos_s = module.fc_pos_s(torch.tanh(module.fc_pos_v(scaled_q)))
+    pos = torch.sigmoid(pos_s) * (len_k_s - 1)
+    graph_attn_mask_select = reference_select_graph_attn_mask(graph_attn_bias.expand(-1, n_heads, -1, -1), pos)
+    attn = attn + (-0.5 * graph_attn_mask_select * graph_attn_mask_select) / ((0.5 * module.pos_win) ** 2)
+
+    attn = attn.masked_fill(bias, torch.finfo(attn.dtype).min)
+    weights = F.softmax(attn, dim=-1)
+    graph_out = torch.matmul(weights, v).transpose(1, 2).contiguous().view(batch_size, len_q, module.d_model)
+    return module.fc_out(graph_out), weights
+
+
+class GraphAttentionGatherTest(unittest.TestCase):
+    """按行 gather 的实现与原先展开 + advanced indexing 的实现在数值上一致"""
+
+    shapes = [(2, 4, 7, 5), (3, 8, 1, 30), (1, 2, 50, 1), (4, 1, 13, 2)]
+
+    def test_select_graph_attn_mask(self):
+        torch.manual_seed(0)
+        for batch_size, n_heads, len_q, len_k_s in self.shapes:
+            graph = torch.rand(batch_size, n_heads, len_k_s, len_k_s)
+            pos = torch.rand(batch_size, n_heads, len_q, 1) * (len_k_s - 1)
+            # pos 为整数时 pos_up == pos_down，包括首尾两个段落
+            pos[..., 0, :] = 0.0
+            pos[..., -1, :] = len_k_s - 1
+            pos[..., len_q // 2, :] = float(len_k_s // 2)
+
+            expected = reference_select_graph_attn_mask(graph, pos)
+            actual = GraphScaledDotProductAttentionWithMask._select_graph_attn_mask(graph, pos)
+            torch.testing.assert_close(actual, expected, rtol=0, atol=0)
+
+    def test_forward(self):
+        torch.manual_seed(0)
+        dim_per_head = 16
+        for batch_size, n_heads, len_q, len_k_s in self.shapes:
+            module = make_module(n_heads, dim_per_head)
+            q = torch.randn(batch_size, n_heads, len_q, dim_per_head)
+            k = torch.randn(batch_size, n_heads, len_k_s, dim_per_head)
+            v = torch.randn(batch_size, n_heads, len_k_s, dim_per_head)
+            bias = torch.rand(batch_size, 1, 1, len_k_s) > 0.7
+            bias[..., 0] = False
+            graph = torch.rand(batch_size, 1, len_k_s, len_k_s, requires_grad=True)
+
+            # fc_pos_s 的 bias 为 0 / ±100 时 sigmoid 恰好为 0.5 / 1 / 0，pos 落在整数段落上
+            for pos_bias in [None, 0.0, 100.0, -100.0]:
+                if pos_bias is not None:
+                    with torch.no_grad():
+                        module.fc_pos_s.weight.zero_()
+                        module.fc_pos_s.bias.fill_(pos_bias)
+                q_ref = q.clone().requires_grad_()
+                q_new = q.clone().requires_grad_()
+
+                out_ref, weights_ref = reference_forward(module, q_ref, k, v, bias, graph)
+                grads_ref = torch.autograd.grad(out_ref.sum(), [q_ref, graph])
+                out, weights = module(q_new, k, v, bias, graph)
+                grads = torch.autograd.grad(out.sum(), [q_new, graph])
+
+                torch.testing.assert_close(out, out_ref)
+                torch.testing.assert_close(weights, weights_ref)
+                for grad, grad_ref in zip(grads, grads_ref):
+                    torch.testing.assert_close(grad, grad_ref)
+
+
+class GraphAttentionPaddingTest(unittest.TestCase):
+
+    def test_output_does_not_depend_on_paragraph_padding(self):
+        """
+        pad 到 batch 内最大段落数与 pad 到 max_para_num 时，真实段落上的输出应一致
+        """
+        torch.manual_seed(0)
+        batch_size, n_heads, dim_per_head, len_q, max_para_num = 3, 4, 8, 11, 30
+        module = make_module(n_heads, dim_per_head, max_para_num)
+        for n_blocks in [1, 2, 7, 29, 30]:
+            para_nums = torch.randint(1, n_blocks + 1, [batch_size])
+            para_nums[0] = n_blocks
+
+            q = torch.randn(batch_size, n_heads, len_q, dim_per_head)
+            k = torch.randn(batch_size, n_heads, max_para_num, dim_per_head)
+            v = torch.randn(batch_size, n_heads, max_para_num, dim_per_head)
+            # [batch_size, 1, 1, max_para_num]
+            bias = (torch.arange(max_para_num) >= para_nums[:, None]).view(batch_size, 1, 1, max_para_num)
+            # padding 段落对应的行和列为 1.0，与 DataBatch 一致
+            graph = torch.rand(batch_size, 1, max_para_num, max_para_num)
+            graph = graph.masked_fill(bias | bias.transpose(2, 3), 1.0)
+
+            with torch.no_grad():
+                out_full, weights_full = module(q, k, v, bias, graph)
+                out, weights = module(q, k[:, :, :n_blocks], v[:, :, :n_blocks], bias[..., :n_blocks],
+                                      graph[:, :, :n_blocks, :n_blocks])
+
+            torch.testing.assert_close(out, out_full)
+            torch.testing.assert_close(weights, weights_full[..., :n_blocks])
+
+
+if __name__ == '__main__':
+    unittest.main()
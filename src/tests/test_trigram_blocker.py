@@ -0,0 +1,76 @@
+import random
+import unittest
+
+import torch
+
+from utils.trigram_blocker import TrigramBlocker
+
+
+def reference_is_repeated(seq, id2is_full_token, space_idx):
+    """
+    原先 Translator.block_trigram 的实现：每次把整个候选序列还原成 full token，再检查最后一个 trigram 是否重复
+    :param seq: sub-token id 的 list
+    """
+    full_tokens = []
+    pre_is_space = False
+    for sub_token_id in seq:
+        if sub_token_id == space_idx:
+            pre_is_space = True
+            continue
+        if id2is_full_token[sub_token_id] or not full_tokens or pre_is_space:
+            full_tokens.append([sub_token_id])
+        else:
+            full_tokens[-1].append(sub_token_id)
+        pre_is_space = False
+
+    full_tokens = [tuple(full_token) for full_token in full_tokens]
+    if len(full_tokens) <= 3:
+        return False
+    trigrams = set(tuple(full_tokens[end - 3: end]) for end in range(3, len(full_tokens)))
+    return tuple(full_tokens[-3:]) in trigrams
+
+
+class TrigramBlockerTest(unittest.TestCase):
+
+    def test_block_mask_matches_reference(self):
+        """
+        随机的小词表上做多步 advance / reorder，每一步的 block_mask 与逐个候选重新分词的结果一致
+        """
+        rng = random.Random(0)
+        torch.manual_seed(0)
+        vocab_size, space_idx, bos_idx = 8, 1, 0
+        n_hyps, n_candis, n_steps = 6, 5, 60
+
+        n_blocked = 0
+        for _ in range(5):
+            id2is_full_token = [rng.random() < 0.6 for _ in range(vocab_size)]
+            blocker = TrigramBlocker(id2is_full_token, space_idx, n_hyps, bos_idx)
+            seqs = [[bos_idx] for _ in range(n_hyps)]
+
+            for step in range(n_steps):
+                candidates = torch.randint(0, vocab_size, [n_hyps, n_candis])
+                parents = torch.randint(0, n_hyps, [n_hyps, n_candis])
+                for candis_parents in [None, parents]:
+                    mask = blocker.block_mask(candidates, candis_parents)
+                    for row in range(n_hyps):
+                        for col in range(n_candis):
+                            parent = row if candis_parents is None else candis_parents[row, col].item()
+                            seq = seqs[parent] + [candidates[row, col].item()]
+                            expected = reference_is_repeated(seq, id2is_full_token, space_idx)
+                            self.assertEqual(mask[row, col].item() < 0, expected)
+                            n_blocked += expected
+
+                select_indices = torch.randint(0, n_hyps, [n_hyps])
+                if step % 7 == 6:
+                    blocker.reorder(select_indices)
+                    seqs = [list(seqs[i]) for i in select_indices.tolist()]
+                else:
+                    tokens = torch.randint(0, vocab_size, [n_hyps])
+                    blocker.advance(select_indices, tokens)
+                    seqs = [seqs[i] + [token] for i, token in zip(select_indices.tolist(), tokens.tolist())]
+
+        self.assertGreater(n_blocked, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,36 +2,58 @@ import torch
 
 
 class BeamHypotheses:
+    """
+    以定长张量保存每个 batch 中已完成的最优的 beam_size 个假设，避免逐个元素的 python 循环
+    """
 
-    def __init__(self, beam_size, max_length, length_penalty):
-        self.max_length = max_length - 1  # 忽略<BOS>
+    def __init__(self, batch_size, beam_size, max_length, length_penalty, device):
+        self.max_length = max_length
         self.length_penalty = length_penalty
         self.beam_size = beam_size
-        self.beams = []
-        self.worst_score = 1e9
-
-    def __len__(self):
-        return len(self.beams)
-
-    def add(self, hyp, sum_logprobs):
-        length_penalty = ((5.0 + hyp.size(-1)) / 6.0) ** self.length_penalty
-        score = sum_logprobs / length_penalty
-        if len(self) < self.beam_size or score > self.worst_score:
-            self.beams.append((score, hyp))
-            if len(self) > self.beam_size:
-                sorted_next_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
-                del self.beams[sorted_next_scores[0][1]]
-                self.worst_score = sorted_next_scores[1][0]
-            else:
-                self.worst_score = min(score, self.worst_score)
+
+        # 未填充的位置分数为 -inf
+        # [batch_size, beam_size]
+        self.scores = torch.full([batch_size, beam_size], float('-inf'), dtype=torch.float, device=device)
+        # [batch_size, beam_size, max_length]
+        self.sequences = torch.zeros([batch_size, beam_size, max_length], dtype=torch.int64, device=device)
+        # [batch_size, beam_size]
+        self.lengths = torch.zeros([batch_size, beam_size], dtype=torch.int64, device=device)
+
+    def add(self, hyps, sum_logprobs, mask):
+        """
+        :param hyps: [batch_size, n_hyps, cur_len]
+        :param sum_logprobs: [batch_size, n_hyps]
+        :param mask: [batch_size, n_hyps] 为 True 的假设才加入集合
+        """
+        batch_size, n_hyps, cur_len = hyps.size()
+        length_penalty = ((5.0 + cur_len) / 6.0) ** self.length_penalty
+        scores = (sum_logprobs / length_penalty).masked_fill(~mask, float('-inf'))
+
+        # [batch_size, n_hyps, max_length]
+        padded_hyps = hyps.new_zeros([batch_size, n_hyps, self.max_length])
+        padded_hyps[:, :, :cur_len] = hyps
+
+        # [batch_size, beam_size + n_hyps]
+        all_scores = torch.cat([self.scores, scores], dim=1)
+        all_lengths = torch.cat([self.lengths, torch.full_like(scores, cur_len, dtype=torch.int64)], dim=1)
+        # [batch_size, beam_size + n_hyps, max_length]
+        all_sequences = torch.cat([self.sequences, padded_hyps], dim=1)
+
+        # 只保留分数最高的 beam_size 个
+        # [batch_size, beam_size]
+        self.scores, keep_indices = all_scores.topk(self.beam_size, dim=1)
+        self.lengths = all_lengths.gather(1, keep_indices)
+        self.sequences = all_sequences.gather(1, keep_indices.unsqueeze(-1).expand(-1, -1, self.max_length))
 
     def is_done(self, best_sum_logprobs, cur_len):
-        if len(self) < self.beam_size:
-            return False
-        else:
-            cur_score = best_sum_logprobs / (((5.0 + cur_len) / 6.0) ** self.length_penalty)
-            ret = self.worst_score >= cur_score
-            return ret
+        """
+        :param best_sum_logprobs: [batch_size]
+        :return: [batch_size]
+        """
+        is_full = self.scores.gt(float('-inf')).all(dim=1)
+        worst_scores = self.scores.min(dim=1)[0]
+        cur_scores = best_sum_logprobs / (((5.0 + cur_len) / 6.0) ** self.length_penalty)
+        return is_full & worst_scores.ge(cur_scores)
 
 
 class BeamSearch:
@@ -44,60 +66,56 @@ class BeamSearch:
         self.length_penalty = length_penalty
         self.device = device
 
-        self._beam_hyps = [
-            BeamHypotheses(
-                beam_size=beam_size, max_length=max_length, length_penalty=length_penalty
-            )
-            for _ in range(batch_size)
-        ]
-        self._done = torch.tensor([False for _ in range(batch_size)], dtype=torch.bool, device=self.device)
+        self._beam_hyps = BeamHypotheses(batch_size, beam_size, max_length, length_penalty, device)
+        self._done = torch.zeros([batch_size], dtype=torch.bool, device=self.device)
+        # [batch_size]
+        self._beam_offset = torch.arange(0, batch_size * beam_size, step=beam_size, dtype=torch.int64, device=device)
 
     @property
     def is_done(self) -> bool:
-        return self._done.all()
+        return bool(self._done.all())
 
     def process(self, input_ids, next_scores, next_tokens, next_indices, pad_idx, eos_idx):
         """
-        :param next_indices: 选取的 beam 在 beam_size 中的索引
+        :param input_ids: [batch_size * beam_size, cur_len]
+        :param next_scores: [batch_size, n_candis] 按分数降序排列的候选
+        :param next_tokens: [batch_size, n_candis]
+        :param next_indices: 选取的 beam 在 beam_size 中的索引 [batch_size, n_candis]
         """
-        batch_size, beam_size, device = self.batch_size, self.beam_size, self.device
+        beam_size = self.beam_size
 
         cur_len = input_ids.size(-1)
-        next_beam_scores = torch.zeros([batch_size, beam_size], dtype=torch.float, device=device)
-        next_beam_tokens = torch.full_like(next_beam_scores, 0, dtype=torch.int64, device=device)
-        next_beam_indices = torch.full_like(next_beam_scores, 0, dtype=torch.int64, device=device)
-
-        for batch_idx, beam_hyp in enumerate(self._beam_hyps):
-            if self._done[batch_idx]:
-                next_beam_scores[batch_idx, :] = 0
-                next_beam_tokens[batch_idx, :] = pad_idx
-                next_beam_indices[batch_idx, :] = 0
-                continue
-
-            beam_idx = 0
-            for beam_token_rank, (next_token, next_score, next_index) in enumerate(
-                zip(next_tokens[batch_idx], next_scores[batch_idx], next_indices[batch_idx])
-            ):
-                batch_beam_idx = batch_idx * beam_size + next_index
-                if next_token.item() == eos_idx:
-                    # 不属于 topk 个 beam 则不添加
-                    if beam_token_rank >= beam_size:
-                        continue
-                    # 将完成的句子添加进集合
-                    beam_hyp.add(input_ids[batch_beam_idx].clone(), next_score.item())
-                else:
-                    # 添加下一个单词
-                    next_beam_scores[batch_idx, beam_idx] = next_score
-                    next_beam_tokens[batch_idx, beam_idx] = next_token
-                    next_beam_indices[batch_idx, beam_idx] = batch_beam_idx
-                    beam_idx += 1
-
-                # 当 beam 满了时，退出循环
-                if beam_idx == beam_size:
-                    break
-
-            self._done[batch_idx] = self._done[batch_idx] or beam_hyp.is_done(
-                next_scores[batch_idx].max().item(), cur_len)
+        n_candis = next_tokens.size(-1)
+
+        # [batch_size, n_candis]
+        is_eos = next_tokens.eq(eos_idx)
+        batch_beam_indices = next_indices + self._beam_offset.unsqueeze(1)
+
+        # 排在前 beam_size 的 eos 候选作为完成的句子加入集合
+        # [batch_size, beam_size]
+        is_finished = is_eos[:, :beam_size] & ~self._done.unsqueeze(1)
+        self._beam_hyps.add(
+            input_ids[batch_beam_indices[:, :beam_size]], next_scores[:, :beam_size], is_finished
+        )
+
+        # 按顺序取前 beam_size 个非 eos 的候选作为下一步的 beam
+        # [batch_size, n_candis]
+        non_eos_rank = (~is_eos).to(torch.int64).cumsum(dim=-1) - 1
+        non_eos_rank = non_eos_rank.masked_fill(is_eos, n_candis)
+        # [batch_size, beam_size]
+        _, selected = non_eos_rank.topk(beam_size, dim=-1, largest=False, sorted=True)
+
+        next_beam_scores = next_scores.gather(1, selected)
+        next_beam_tokens = next_tokens.gather(1, selected)
+        next_beam_indices = batch_beam_indices.gather(1, selected)
+
+        # 已完成的 batch 不再扩展
+        done = self._done.unsqueeze(1)
+        next_beam_scores = next_beam_scores.masked_fill(done, 0.0)
+        next_beam_tokens = next_beam_tokens.masked_fill(done, pad_idx)
+        next_beam_indices = next_beam_indices.masked_fill(done, 0)
+
+        self._done = self._done | self._beam_hyps.is_done(next_scores.max(dim=-1)[0], cur_len)
 
         return {
             'next_beam_scores': next_beam_scores.view(-1),
@@ -107,42 +125,28 @@ class BeamSearch:
 
     def finalize(self, input_ids, final_beam_scores, pad_idx, eos_idx):
         batch_size, beam_size, n_best, device = self.batch_size, self.beam_size, self.n_best, self.device
+        max_length = self.max_length
 
         # 将所有未完成的句子添加进集合
-        for batch_idx, beam_hyp in enumerate(self._beam_hyps):
-            if self._done[batch_idx]:
-                continue
-            for beam_id in range(beam_size):
-                batch_beam_idx = batch_idx * beam_size + beam_id
-                final_score = final_beam_scores[batch_beam_idx].item()
-                final_tokens = input_ids[batch_beam_idx]
-                beam_hyp.add(final_tokens, final_score)
-
-        sent_lengths = torch.empty(batch_size * n_best, dtype=torch.int64, device=device)
-        best = []
-        best_scores = torch.zeros(batch_size * n_best, dtype=torch.float, device=device)
-
-        for i, beam_hyp in enumerate(self._beam_hyps):
-            sorted_hyps = sorted(beam_hyp.beams, key=lambda x: x[0])
-            for j in range(n_best):
-                best_hyp_tuple = sorted_hyps.pop()
-                best_score = best_hyp_tuple[0]
-                best_hyp = best_hyp_tuple[1]
-                sent_lengths[n_best * i + j] = len(best_hyp) - 1
-
-                best.append(best_hyp[1:])
-                best_scores[n_best * i + j] = best_score
-
-        sent_max_len = min(sent_lengths.max().item() + 1, self.max_length)
-        decoded = torch.empty([batch_size * n_best, sent_max_len], dtype=torch.int64, device=device)
-
-        if sent_lengths.min().item() != sent_lengths.max().item():
-            decoded.fill_(pad_idx)
-
-        for i, hypo in enumerate(best):
-            decoded[i, :sent_lengths[i]] = hypo
-            if sent_lengths[i] < self.max_length:
-                decoded[i, sent_lengths[i]] = eos_idx
-
-        decoded = decoded.view(batch_size, n_best, sent_max_len)
-        return {'sequences': decoded, 'sequence_scores': best_scores}
+        not_done = (~self._done).unsqueeze(1).expand(-1, beam_size)
+        self._beam_hyps.add(
+            input_ids.view(batch_size, beam_size, -1), final_beam_scores.view(batch_size, beam_size), not_done
+        )
+
+        # [batch_size, n_best]
+        best_scores, best_indices = self._beam_hyps.scores.topk(n_best, dim=1)
+        # [batch_size, n_best, max_length]
+        best = self._beam_hyps.sequences.gather(1, best_indices.unsqueeze(-1).expand(-1, -1, max_length))
+        # 忽略 <BOS> 后的长度 [batch_size, n_best, 1]
+        sent_lengths = (self._beam_hyps.lengths.gather(1, best_indices) - 1).unsqueeze(-1)
+
+        sent_max_len = min(sent_lengths.max().item() + 1, max_length)
+
+        # [batch_size, n_best, max_length]
+        decoded = torch.cat([best[:, :, 1:], best.new_full([batch_size, n_best, 1], pad_idx)], dim=-1)
+        positions = torch.arange(max_length, dtype=torch.int64, device=device).view(1, 1, -1)
+        decoded = decoded.masked_fill(positions.ge(sent_lengths), pad_idx)
+        decoded = decoded.masked_fill(positions.eq(sent_lengths), eos_idx)
+
+        decoded = decoded[:, :, :sent_max_len]
+        return {'sequences': decoded, 'sequence_scores': best_scores.view(-1)}
@@ -0,0 +1,51 @@
+import os
+import datetime
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo', timeout=30):
+    """
+    用 torchrun 启动时 (环境变量 WORLD_SIZE > 1) 初始化进程组，rank / world_size 等由 torchrun 通过环境变量传入
+    :param timeout: 集合通信的超时时间 (分钟)，需要大于 rank 0 保存 checkpoint 时其他进程的等待时间
+    :return: local_rank，单进程时为 0
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=backend, timeout=datetime.timedelta(minutes=timeout))
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_master():
+    """只在 rank 0 上保存 checkpoint、写日志文件和 tensorboard、做验证"""
+    return get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+    """各进程的 tensor 求和，单进程时原样返回"""
+    if is_distributed():
+        tensor = tensor.clone()
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def barrier():
+    """等待所有进程到达这里，单进程时直接返回"""
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
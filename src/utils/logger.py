@@ -3,9 +3,9 @@ import logging
 logger = logging.getLogger()
 
 
-def init_logger(log_file=None, log_file_level=logging.NOTSET):
+def init_logger(log_file=None, log_file_level=logging.NOTSET, level=logging.INFO):
     log_format = logging.Formatter("[%(asctime)s %(levelname)s] %(message)s")
-    logger.setLevel(logging.INFO)
+    logger.setLevel(level)
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(log_format)
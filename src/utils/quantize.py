@@ -0,0 +1,29 @@
+import os
+import torch
+import torch.nn as nn
+
+
+# 量化模型的 checkpoint 保存在原 checkpoint 同目录下，文件名加上这个前缀
+QUANTIZED_PREFIX = 'int8_'
+
+
+def quantize_model(model):
+    """
+    对模型中所有 nn.Linear 做动态 int8 量化：权重保存为 int8，激活在运行时按 batch 量化，
+    只支持 CPU 推理
+    """
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_checkpoint_path(checkpoint_path):
+    dirname, basename = os.path.split(checkpoint_path)
+    return os.path.join(dirname, QUANTIZED_PREFIX + basename)
+
+
+def save_quantized(model, args, path):
+    torch.save({'model': model.state_dict(), 'opt': args, 'quantize': 'int8'}, path)
+
+
+def is_quantized(checkpoint):
+    return checkpoint.get('quantize') == 'int8'
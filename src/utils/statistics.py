@@ -6,32 +6,39 @@ from utils.logger import logger
 
 
 class Statistics(object):
+    """
+    loss / n_words / n_correct 可以是数值，也可以是 device 上的标量张量。
+    训练时按张量累加，不在每一步同步到 host，只在计算 accuracy / xent / ppl (report 时) 才转换为 float
+    """
 
     def __init__(self, loss=0, n_words=0, n_correct=0):
         self.loss = loss
         self.n_words = n_words
         self.n_correct = n_correct
         self.n_src_words = 0
+        # 参数更新的次数，每次更新使用 accum_count 个 batch
+        self.n_steps = 0
         self.start_time = time.time()
 
     def update(self, stat, update_n_src_words=False):
-        self.loss += stat.loss
-        self.n_words += stat.n_words
-        self.n_correct += stat.n_correct
+        # 不做原地加法，避免修改 stat 中的张量
+        self.loss = self.loss + stat.loss
+        self.n_words = self.n_words + stat.n_words
+        self.n_correct = self.n_correct + stat.n_correct
 
         if update_n_src_words:
             self.n_src_words += stat.n_src_words
 
     def accuracy(self):
-        return 100 * (self.n_correct / self.n_words)
+        return 100 * (float(self.n_correct) / float(self.n_words))
 
     def xent(self):
         """计算交叉熵"""
-        return self.loss / self.n_words
+        return float(self.loss) / float(self.n_words)
 
     def ppl(self):
         """计算困惑度 perplexity"""
-        return math.exp(min(self.loss / self.n_words, 100))
+        return math.exp(min(self.xent(), 100))
 
     def elapsed_time(self):
         return time.time() - self.start_time
@@ -40,10 +47,10 @@ class Statistics(object):
         t = self.elapsed_time()
         logger.info(
             ("Step %2d/%5d; acc: %6.2f; ppl: %5.2f; xent: %4.2f; "
-             "lr: %7.5f; %3.0f/%3.0f tok/s; %6.0f sec")
+             "lr: %7.5f; %3.0f/%3.0f tok/s; %5.0f tgt tok/step; %6.0f sec")
             % (step, num_steps, self.accuracy(), self.ppl(), self.xent(),
-               learning_rate, self.n_src_words / (t + 1e-5), self.n_words / (t + 1e-5),
-               time.time() - start)
+               learning_rate, self.n_src_words / (t + 1e-5), float(self.n_words) / (t + 1e-5),
+               float(self.n_words) / max(self.n_steps, 1), time.time() - start)
         )
         sys.stdout.flush()
 
@@ -52,5 +59,5 @@ class Statistics(object):
         writer.add_scalar(prefix + "/xent", self.xent(), step)
         writer.add_scalar(prefix + "/ppl", self.ppl(), step)
         writer.add_scalar(prefix + "/accuracy", self.accuracy(), step)
-        writer.add_scalar(prefix + "tgtper", self.n_words / t, step)
+        writer.add_scalar(prefix + "tgtper", float(self.n_words) / t, step)
         writer.add_scalar(prefix + "/lr", learning_rate, step)
@@ -1,3 +1,6 @@
+import torch
+
+
 def tile(x, count, dim=0):
     """
     将 x 在 dim 维铺开 count 次
@@ -22,3 +25,22 @@ def tile(x, count, dim=0):
     if dim != 0:
         x = x.permute(perm).contiguous()
     return x
+
+
+def unpack(x, mask):
+    """
+    x = y[mask] 的逆操作：按 mask 把 x 的各行放回原来的位置，其余位置补 0
+    unpack([[1, 2], [3, 4]], [True, False, True]) => [[1, 2], [0, 0], [3, 4]]
+    """
+    out = x.new_zeros(tuple(mask.shape) + tuple(x.shape[1:]))
+    out[mask] = x
+    return out
+
+
+def autocast(device, enabled):
+    """
+    bf16 自动混合精度：matmul/linear 在 bf16 下计算，attention 的 mask 按张量的精度取最小值，
+    generator 的 log_softmax 和 loss 仍为 fp32。enabled 为 False 时不做任何事
+    :param device: 'cpu' / 'cuda' / torch.device
+    """
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=enabled)
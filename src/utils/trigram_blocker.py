@@ -0,0 +1,141 @@
+import torch
+
+# 单词和 trigram 用两组独立的多项式 hash 表示，模数小于 2^31，乘法不会超出 int64。
+# 三个单词组合成 trigram 时使用另一组 base，否则单词边界不同的 trigram 会得到相同的 hash
+_HASH_MOD = 2147483647
+_WORD_HASH_BASE = (1000003, 998244353)
+_TRIGRAM_HASH_BASE = (19260817, 402653189)
+
+
+class TrigramBlocker(object):
+    """
+    为 beam 中每个假设增量维护 full token 级别 trigram 的 hash，所有状态都是 [n_hyps, ...] 的张量:
+    words: [n_hyps, 3, 2] 最后三个单词 (最后一个可能还未结束) 的 hash，每个单词是 sub-token id 的序列
+    n_words / pre_is_space: [n_hyps]
+    trigrams: [n_hyps, capacity] 所有由已结束单词组成的 trigram 的 key，只有前 n_trigrams 个有效
+    判断候选、追加 token 和重排假设都是固定几次的张量操作，没有逐个假设或候选的 Python 循环；
+    重排时 index_select 拷贝 [n_hyps, length] 的 trigram key，与 alive_seq 的重排开销相同
+    """
+
+    def __init__(self, id2is_full_token, space_idx, n_hyps, bos_idx, device='cpu'):
+        self.id2is_full_token = torch.tensor(id2is_full_token, dtype=torch.bool, device=device)
+        self.space_idx = space_idx
+        self.word_base = torch.tensor(_WORD_HASH_BASE, dtype=torch.int64, device=device)
+        self.trigram_base = torch.tensor(_TRIGRAM_HASH_BASE, dtype=torch.int64, device=device)
+
+        self.words = torch.zeros(n_hyps, 3, 2, dtype=torch.int64, device=device)
+        self.n_words = torch.zeros(n_hyps, dtype=torch.int64, device=device)
+        self.pre_is_space = torch.zeros(n_hyps, dtype=torch.bool, device=device)
+        # 每追加一个 token 最多增加一个 trigram，容量不够时加倍
+        self.trigrams = torch.zeros(n_hyps, 16, dtype=torch.int64, device=device)
+        self.n_trigrams = torch.zeros(n_hyps, dtype=torch.int64, device=device)
+        # 已追加的 token 数，是 n_trigrams 的上界
+        self.length = 0
+
+        self._update(torch.full([n_hyps], bos_idx, dtype=torch.int64, device=device))
+
+    def _mix(self, h, tokens):
+        """
+        :param h: [..., 2] 单词的 hash
+        :param tokens: [...]
+        :return: [..., 2] 单词末尾追加 tokens 后的 hash
+        """
+        return (h * self.word_base + tokens.unsqueeze(-1) + 1) % _HASH_MOD
+
+    def _trigram_key(self, words):
+        """
+        :param words: [..., 3, 2] 三个单词的 hash
+        :return: [...] 两组 hash 合成的 int64 key
+        """
+        h = (words[..., 0, :] * self.trigram_base + words[..., 1, :]) % _HASH_MOD
+        h = (h * self.trigram_base + words[..., 2, :]) % _HASH_MOD
+        return h[..., 0] * _HASH_MOD + h[..., 1]
+
+    def _transition(self, words, n_words, pre_is_space, tokens):
+        """
+        追加 tokens 后的状态，与 block_mask 共用
+        :param words: [n, 3, 2]
+        :param n_words, pre_is_space, tokens: [n]
+        :return: is_space, starts_new_word, words, n_words
+        """
+        is_space = tokens.eq(self.space_idx)
+        starts_new_word = ~is_space & (self.id2is_full_token[tokens] | n_words.eq(0) | pre_is_space)
+
+        # [n, 3, 2] 开始新单词: (w1, w2, token)
+        new_word = self._mix(torch.zeros_like(words[:, 0]), tokens)
+        shifted = torch.cat([words[:, 1:], new_word.unsqueeze(1)], dim=1)
+        # [n, 3, 2] 延续最后一个单词: (w0, w1, w2 + token)
+        extended = torch.cat([words[:, :2], self._mix(words[:, 2], tokens).unsqueeze(1)], dim=1)
+
+        new_words = torch.where(starts_new_word.view(-1, 1, 1), shifted, extended)
+        new_words = torch.where(is_space.view(-1, 1, 1), words, new_words)
+        return is_space, starts_new_word, new_words, n_words + starts_new_word.long()
+
+    def _update(self, tokens):
+        """
+        :param tokens: [n_hyps] 每个假设追加的 token
+        """
+        is_space, starts_new_word, words, n_words = \
+            self._transition(self.words, self.n_words, self.pre_is_space, tokens)
+
+        if self.length >= self.trigrams.size(1):
+            self.trigrams = torch.cat([self.trigrams, torch.zeros_like(self.trigrams)], dim=1)
+
+        # 最后一个单词已结束，对应的 trigram 写到 n_trigrams 处，不加入时写入的位置仍是无效的
+        add = starts_new_word & self.n_words.ge(3)
+        self.trigrams.scatter_(1, self.n_trigrams.unsqueeze(1), self._trigram_key(self.words).unsqueeze(1))
+        self.n_trigrams = self.n_trigrams + add.long()
+
+        self.words, self.n_words, self.pre_is_space = words, n_words, is_space
+        self.length += 1
+
+    def block_mask(self, candidates, parents=None):
+        """
+        :param candidates: [n_rows, n_candis] 候选 sub-token
+        :param parents: [n_rows, n_candis] 候选所属的假设序号，为 None 时第 i 行属于第 i 个假设
+        :return: [n_rows, n_candis] 会产生重复 trigram 的候选为 -1e20，其余为 0
+        """
+        n_rows, n_candis = candidates.size()
+        if parents is None:
+            parents = torch.arange(n_rows, device=candidates.device).unsqueeze(1).expand(-1, n_candis)
+        # [n_rows * n_candis]
+        parents = parents.reshape(-1)
+
+        words = self.words.index_select(0, parents)
+        _, starts_new_word, new_words, n_words = self._transition(
+            words, self.n_words.index_select(0, parents), self.pre_is_space.index_select(0, parents),
+            candidates.reshape(-1)
+        )
+        # [n_rows * n_candis] 候选产生的最后一个 trigram
+        last_trigram = self._trigram_key(new_words)
+
+        # [n_rows * n_candis, length]
+        trigrams = self.trigrams[:, :self.length].index_select(0, parents)
+        n_trigrams = self.n_trigrams.index_select(0, parents)
+        valid = torch.arange(self.length, device=trigrams.device) < n_trigrams.unsqueeze(1)
+        repeated = (trigrams.eq(last_trigram.unsqueeze(1)) & valid).any(dim=1)
+        # 新单词产生的 trigram 与当前 (还未加入集合的) trigram 相同
+        repeated |= starts_new_word & last_trigram.eq(self._trigram_key(words))
+        repeated &= n_words.gt(3)
+
+        delta = torch.zeros(n_rows * n_candis, dtype=torch.float, device=candidates.device)
+        return delta.masked_fill(repeated, -1e20).view(n_rows, n_candis)
+
+    def advance(self, select_indices, tokens):
+        """
+        跟随 alive_seq 重排假设，并追加新选出的 token
+        :param select_indices: [n_hyps] 新假设来自的旧假设序号
+        :param tokens: [n_hyps] 新假设追加的 token
+        """
+        self.reorder(select_indices)
+        self._update(tokens)
+
+    def reorder(self, select_indices):
+        """
+        :param select_indices: [n_hyps] 保留的假设序号
+        """
+        self.words = self.words.index_select(0, select_indices)
+        self.n_words = self.n_words.index_select(0, select_indices)
+        self.pre_is_space = self.pre_is_space.index_select(0, select_indices)
+        self.trigrams = self.trigrams.index_select(0, select_indices)
+        self.n_trigrams = self.n_trigrams.index_select(0, select_indices)